@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+#
+# Benchmarks of etl.py on synthetic dbGaP-shaped inputs. Every case
+# generates a data dictionary and a phenotype file for one datemode, based
+# on Test.yml, Test_data_DD.csv and the AREDS/AREDS2/ACCORD configs, scaled
+# by the number of rows, synthetic variables and enumerated values per
+# variable. The stages of an ETL run are timed in a fresh process per case,
+# so that the peak RSS is that of the case alone. The facts files of all
+# engines of a case must be identical, and with --compare identical to the
+# baseline's.
+#
+# python benchmark.py --rows 10000,100000 --save baseline.json
+# python benchmark.py --rows 10000,100000 --compare baseline.json
+#
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from random import Random
+
+import etl
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_VERSION = 2
+
+# datemode -> config the case is based on
+MODE_CONFIGS = {
+    0: "Test.yml",
+    1: "Test.yml",
+    2: "AREDS_fundus.yml",
+    3: "Test.yml",
+    4: "Test.yml",
+    5: "AREDS_followup.yml",
+    6: "AREDS2_rcf.yml",
+    7: "ACCORD_f34.yml",
+}
+VISITS = 4  # Rows per subject for the visit-based datemodes
+
+# Stages that read the input and generate and write facts
+FACT_STAGES = ("read_facts", "collect_facts", "write_facts")
+ENGINES = ("rows", "columnar", "compact", "stream", "pipeline")
+
+
+def repo_file(name):
+    return os.path.join(HERE, name)
+
+
+#
+# A column of a synthetic phenotype file: its data dictionary entry and a
+# function of a random generator that returns the value of a cell
+#
+def column(varname, description, vartype, enums, value):
+    return {
+        "varname": varname,
+        "description": description,
+        "type": vartype,
+        "enums": enums,
+        "value": value,
+    }
+
+
+def choice(values):
+    return lambda rng: rng.choice(values)
+
+
+def sometimes(value, empty=0.1):
+    return lambda rng: "" if rng.random() < empty else value(rng)
+
+
+#
+# Synthetic variables VAR001, VAR002, ...: encoded values with cardinality
+# codes, integers, decimals and strings in turn. Some strings are notes
+# with a line break, quoted in the phenotype file. For datemode 2 the name
+# suffixes tie the variables to the time variables.
+#
+def synthetic_columns(ncolumns, cardinality, suffixes=("",)):
+    columns = []
+    for k in range(ncolumns):
+        varname = f"VAR{k + 1:03d}{suffixes[k % len(suffixes)]}"
+        enums = []
+        if k % 4 == 0:
+            codes = [str(c) for c in range(1, cardinality + 1)]
+            enums = [f"{c}=Level {c} of {varname}" for c in codes]
+            vartype, value = "encoded value", choice(codes)
+        elif k % 4 == 1:
+            vartype, value = "num", lambda rng: str(rng.randint(0, 300))
+        elif k % 4 == 2:
+            vartype, value = "decimal", lambda rng: f"{rng.uniform(0, 99):.2f}"
+        else:
+            vartype, value = "string", choice(
+                ["yes", "no", "n/a", "see notes", 'notes:\n"stable", 5\'10"']
+            )
+        columns.append(
+            column(
+                varname,
+                f"Synthetic variable {k + 1}",
+                vartype,
+                enums,
+                sometimes(value),
+            )
+        )
+    return columns
+
+
+# The variables of Test_data_DD.csv, with demographics and ICD9 codes
+def test_columns():
+    with open(repo_file(etl.ICD_CODES_FILE)) as f:
+        icd9_codes = [
+            row[-1][len("ICD9:") :]
+            for row in csv.reader(f)
+            if row[-1].startswith("ICD9:")
+        ]
+    columns = []
+    with open(repo_file("Test_data_DD.csv")) as f:
+        for row in csv.DictReader(f):
+            varname = row["VARNAME"]
+            enums = row["VALUES"].split(";") if row["VALUES"] else []
+            if varname == "SUBJECT_ID":
+                continue
+            elif varname == "AGE":
+                value = lambda rng: str(rng.randint(40, 90))
+            elif varname.startswith("ICD9"):
+                value = sometimes(choice(icd9_codes), 0.3)
+            else:
+                value = choice([enum.split("=", 1)[0] for enum in enums])
+            columns.append(
+                column(varname, row["VARDESC"], row["TYPE"], enums, value)
+            )
+    return columns
+
+
+def number(low, high, digits=0):
+    return lambda rng: f"{rng.uniform(low, high):.{digits}f}"
+
+
+#
+# Config overrides, columns besides the patient id and rows per subject of
+# a case
+#
+def case_columns(datemode, ncolumns, cardinality):
+    overrides = {}
+    visits = VISITS
+    if datemode in (0, 1, 3, 4):
+        columns = test_columns()
+        if datemode == 0:
+            visits = 1
+        else:
+            overrides["datemode"] = datemode
+            overrides["timevar"] = {"default": "VISDAY"}
+            columns.append(
+                column(
+                    "VISDAY", "Days from baseline", "num", [], number(0, 2000)
+                )
+            )
+        if datemode in (3, 4):
+            overrides["additionaltimevar"] = ["EVENTDAY"]
+            overrides["additionaldatedifftimeunits"] = 2
+            columns.append(
+                column(
+                    "EVENTDAY",
+                    "Days from visit to event",
+                    "num",
+                    [],
+                    sometimes(number(0, 90), 0.5),
+                )
+            )
+        columns += synthetic_columns(ncolumns, cardinality)
+    elif datemode == 2:
+        visits = 1
+        columns = [
+            column(timevar, timevar, "num", [], sometimes(number(0, 10, 1)))
+            for timevar in ("REPHTIME", "LEPHTIME")
+        ]
+        columns += synthetic_columns(ncolumns, cardinality, ("RE", "LE", ""))
+    elif datemode == 5:
+        visno = ["BL", "01", "02", "04", "06", "08", "1.5", "10", "12"]
+        columns = [column("VISNO", "Visit", "string", [], choice(visno))]
+        columns += synthetic_columns(ncolumns, cardinality)
+    elif datemode == 6:
+        overrides["visitdatefile"] = repo_file("AREDS2_VISNO_Dates.csv")
+        visit_dates = etl.load_visit_dates(overrides["visitdatefile"])
+        visno = [visit for visit, date in visit_dates.items() if date]
+        columns = [
+            column("VISNO", "Visit number", "string", [], choice(visno))
+        ]
+        columns += synthetic_columns(ncolumns, cardinality)
+    elif datemode == 7:
+        visit = ["BLR", "F04", "F08", "F12", "F24", "F36", "F48"]
+        columns = [column("visit", "Visit", "string", [], choice(visit))]
+        columns += synthetic_columns(ncolumns, cardinality)
+    return overrides, columns, visits
+
+
+def case_name(datemode, rows, ncolumns, cardinality):
+    return f"mode{datemode}-r{rows}-c{ncolumns}-e{cardinality}"
+
+
+#
+# Write the data dictionary and phenotype file of a case to workdir.
+# Returns the config, dictionary and phenotype file of the case.
+#
+def generate_case(workdir, datemode, rows, ncolumns, cardinality):
+    name = case_name(datemode, rows, ncolumns, cardinality)
+    config = etl.load_conf(repo_file(MODE_CONFIGS[datemode]))
+    overrides, columns, visits = case_columns(datemode, ncolumns, cardinality)
+    config.update(overrides)
+    config["filebase"] = os.path.join(workdir, name)
+    if "demographics_file" in config:
+        config["demographics_file"] = repo_file(config["demographics_file"])
+    columns.insert(
+        0, column(config["patientid"], "Subject ID", "string", [], None)
+    )
+
+    # AREDS2 dictionaries are tab-separated with one enumerated value per
+    # cell, the others have a column of separated enumerated values
+    header = [
+        config["varname"],
+        config["description"],
+        config["typename"],
+    ]
+    if config.get("dictformat") == "areds2":
+        dictionary = os.path.join(workdir, name + "_dd.txt")
+        with open(dictionary, "w", newline="", encoding="latin1") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(header + ["UNITS"])
+            for c in columns:
+                cells = [c["varname"], c["description"], c["type"], ""]
+                writer.writerow(cells + (c["enums"] or [""]))
+    else:
+        dictionary = os.path.join(workdir, name + "_dd.csv")
+        with open(dictionary, "w", newline="", encoding="latin1") as f:
+            if config.get("dictformat") == "areds":
+                f.write("!#! Synthetic data dictionary\n")
+            writer = csv.writer(f)
+            writer.writerow(header + [config["enumname"]])
+            for c in columns:
+                cells = [c["varname"], c["description"], c["type"]]
+                writer.writerow(cells + [";".join(c["enums"])])
+
+    rng = Random(name)
+    if datemode in (2, 5, 6):
+        phenofile = os.path.join(workdir, name + ".txt")
+        encoding, delimiter = "latin1", "\t"
+    else:
+        phenofile = os.path.join(workdir, name + ".csv")
+        encoding, delimiter = "utf-8", ","
+    with open(phenofile, "w", newline="", encoding=encoding) as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow([c["varname"] for c in columns])
+        for i in range(rows):
+            writer.writerow(
+                [f"S{i // visits:07d}"]
+                + [c["value"](rng) for c in columns[1:]]
+            )
+    return config, dictionary, phenofile
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1 << 20)  # bytes
+    return peak / (1 << 10)  # kilobytes
+
+
+#
+# ETL of a case, stage by stage, in the current process
+#
+def run_case(config, dictionary, phenofile, engine):
+    stages = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        stages[stage] = time.perf_counter() - start
+        return result
+
+    def read_references():
+        etldb.read_visit_dates_file()
+        etldb.read_demographics_file()
+
+    def write_icd_concepts(conceptsfile):
+        etldb.read_icd_codes(repo_file(etl.ICD_CODES_FILE))
+        etldb.write_icd_concepts(conceptsfile)
+
+    filebase = config["filebase"]
+    etldb = etl.ETLdbGap(config)
+    timed("read_data_dictionary", etldb.read_data_dictionary, dictionary)
+    timed("read_references", read_references)
+    timed("map_concepts", etldb.map_concepts)
+    timed("write_concepts", etldb.write_concepts, filebase + "_concepts.csv")
+    if engine == "columnar":
+        # Blocks of facts are generated while they are written
+        nfacts = timed(
+            "write_facts",
+            etldb.write_columnar_facts,
+            filebase + "_facts.csv",
+            phenofile,
+        )
+    else:
+        if engine in ("stream", "pipeline"):
+            # Facts are generated while they are written
+            generate = getattr(etldb, engine + "_facts")
+            facts = generate(phenofile)
+        else:
+            timed("read_facts", etldb.read_facts, phenofile)
+            facts = timed(
+                "collect_facts", etldb.collect_facts, engine == "compact"
+            )
+        nfacts = timed(
+            "write_facts",
+            etldb.write_facts,
+            filebase + "_facts.csv",
+            0,
+            facts,
+        )
+    if etldb.icd_codes():
+        timed(
+            "write_icd_concepts",
+            write_icd_concepts,
+            filebase + "_icd_concepts.csv",
+        )
+
+    fact_seconds = sum(stages.get(stage, 0) for stage in FACT_STAGES)
+    return {
+        "facts": nfacts,
+        "digest": etl.file_hash(filebase + "_facts.csv"),
+        "seconds": sum(stages.values()),
+        "facts_per_sec": nfacts / fact_seconds if fact_seconds else 0,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+    }
+
+
+#
+# Run every case repeat times, each in a fresh process, and keep the
+# fastest run. Returns the results and the number of cases whose engines
+# wrote different facts.
+#
+def run_benchmarks(args, workdir):
+    results = {}
+    mismatches = 0
+    context = multiprocessing.get_context("spawn")
+    for datemode, rows, ncolumns, cardinality in itertools.product(
+        args.modes, args.rows, args.columns, args.cardinality
+    ):
+        case = generate_case(workdir, datemode, rows, ncolumns, cardinality)
+        name = case_name(datemode, rows, ncolumns, cardinality)
+        digests = {}
+        for engine in args.engine:
+            key = name + "-" + engine
+            best = None
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    result = pool.submit(run_case, *case, engine).result()
+                if best is None or result["seconds"] < best["seconds"]:
+                    best = result
+            best.update(
+                datemode=datemode,
+                rows=rows,
+                columns=ncolumns,
+                cardinality=cardinality,
+                engine=engine,
+            )
+            results[key] = best
+            digests[engine] = best["digest"]
+            print_result(key, best)
+        if len(set(digests.values())) > 1:
+            engines = ", ".join(sorted(digests))
+            print(f"Error: {name}: the facts of {engines} differ")
+            mismatches += 1
+    return results, mismatches
+
+
+def print_result(key, result):
+    stages = " ".join(
+        f"{stage}={seconds:.2f}s"
+        for stage, seconds in result["stages"].items()
+    )
+    print(
+        f"{key:32} {result['facts']:>10} facts "
+        f"{result['facts_per_sec']:>12,.0f} facts/s "
+        f"{result['peak_rss_mb']:>8.1f} MB  {stages}"
+    )
+
+
+#
+# Compare results with a baseline saved by an earlier run. A case is a
+# regression when its throughput dropped by more than tolerance or its
+# facts file differs. Returns the number of regressions.
+#
+def compare(results, baseline, tolerance):
+    if baseline.get("version") != BENCHMARK_VERSION:
+        print("Error: the baseline was saved by another benchmark version")
+        sys.exit(1)
+    regressions = 0
+    for key, result in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        ratio = result["facts_per_sec"] / base["facts_per_sec"]
+        status = ""
+        if result["facts"] != base["facts"]:
+            status = f"REGRESSION: {base['facts']} facts in the baseline"
+            regressions += 1
+        elif result["digest"] != base["digest"]:
+            status = "REGRESSION: the facts differ from the baseline"
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            status = "REGRESSION"
+            regressions += 1
+        print(
+            f"{key:32} {ratio:6.2f}x throughput "
+            f"{result['peak_rss_mb'] / base['peak_rss_mb']:6.2f}x peak RSS "
+            f"{status}"
+        )
+    return regressions
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows", type=int_list, default=[10000], help="rows per input"
+    )
+    parser.add_argument(
+        "--columns",
+        type=int_list,
+        default=[16],
+        help="synthetic variables per input",
+    )
+    parser.add_argument(
+        "--cardinality",
+        type=int_list,
+        default=[4],
+        help="enumerated values per encoded variable",
+    )
+    parser.add_argument(
+        "--modes",
+        type=int_list,
+        default=sorted(MODE_CONFIGS),
+        help="datemodes to benchmark",
+    )
+    parser.add_argument(
+        "--engine",
+        type=lambda text: text.split(","),
+        default=["rows"],
+        help="fact generation engines to benchmark: rows, columnar, compact "
+        "(rows with dictionary-encoded facts), stream, pipeline",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per case; the best counts"
+    )
+    parser.add_argument(
+        "--workdir", help="keep the generated inputs and outputs here"
+    )
+    parser.add_argument("--save", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="throughput drop that counts as a regression",
+    )
+    args = parser.parse_args()
+    for datemode in args.modes:
+        if datemode not in MODE_CONFIGS:
+            parser.error(f"unknown datemode {datemode}")
+    for engine in args.engine:
+        if engine not in ENGINES:
+            parser.error(f"unknown engine {engine}")
+    return args
+
+
+def main():
+    args = parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        workdir = args.workdir
+    else:
+        workdir = tempfile.mkdtemp(prefix="etl-benchmark-")
+    try:
+        results, mismatches = run_benchmarks(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "version": BENCHMARK_VERSION,
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "results": results,
+                },
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+    regressions = mismatches
+    if baseline is not None:
+        regressions += compare(results, baseline, args.tolerance)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,33 +4,310 @@ import yaml
 import sys
 import re
 import datetime
+import gzip
+import bz2
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 import csv
-from random import sample
+import contextlib
+import copy
+import cProfile
+import hashlib
+import heapq
+import io
+import ipaddress
+import json
+import mmap
+import os
+import pickle
+import pstats
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import dropwhile, islice, repeat
+from operator import itemgetter
+from random import Random
+
+try:
+    import zstandard
+except ImportError:  # Only needed for .zst files
+    zstandard = None
+try:
+    import psycopg2
+except ImportError:  # Only needed for --db postgresql://...
+    psycopg2 = None
+np = pd = None  # NumPy and pandas, imported by import_pandas
+pa = pc = pq = None  # pyarrow, imported by import_pyarrow
+
+ICD_CODES_FILE = "i2b2_icd_codes.csv"
+PROGRESS_INTERVAL = 10  # Seconds between progress reports of --stats
+WRITE_BATCH = 10000  # Facts per writerows call
+PIPELINE_DEPTH = 4  # Blocks or batches queued between --pipeline threads
+SORT_RUN_SIZE = 500000  # Facts sorted in memory per run of --sort
+SORT_FANIN = 64  # Runs merged at a time by --sort
+DEDUP_MEMORY = 2000000  # Fingerprints --dedup disk holds in memory
+LINE_END = re.compile(b"\n")
+COLUMNAR_BLOCK_CELLS = 1000000  # Cells per block of the columnar engine
+NEEDS_QUOTES = re.compile('[,"\r\n]')  # Characters of quoted CSV cells
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "bzip2": ".bz2", "zstd": ".zst"}
+DECOMPRESS_CHUNK = 1 << 20  # Bytes decompressed at a time when reading
+OUTPUT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+ROW_GROUP_SIZE = 100000  # Facts per Parquet row group or Arrow record batch
+FACT_COLUMNS = ("mrn", "start-date", "code", "value")
+CONCEPT_COLUMNS = ("path", "code", "type")
+CONCEPT_CACHE_VERSION = 1  # Bump when the parsed dictionary or concepts change
+# Config keys that the parsed dictionary and the concepts depend on
+CONCEPT_CONFIG_KEYS = (
+    "dictformat",
+    "separator",
+    "enumname",
+    "typename",
+    "varname",
+    "description",
+    "patientid",
+    "pathroot",
+    "include_vars",
+    "exclude_vars",
+)
+
+
+#
+# Reference tables shared by all inputs of a study: the i2b2 ICD code map,
+# visit date files and demographics files, and with keep_concepts the
+# parsed data dictionaries. A ReferenceTables instance loads every file
+# once and can be shared between ETLdbGap instances and, via pickling,
+# with worker processes. A file is loaded again when its mtime or size
+# changed and so did its content hash.
+#
+class ReferenceTables:
+    def __init__(self, keep_concepts=False):
+        self.keep_concepts = keep_concepts
+        self.reloads = 0  # Tables loaded again after their file changed
+        self._tables = {}  # key -> (mtime and size, hash, table)
+
+    def load(self, reader, path, *args):
+        key = (reader.__name__, os.path.abspath(path)) + args
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = self._tables.get(key)
+        if entry is not None and entry[0] != stamp:
+            digest = file_hash(path)
+            if digest == entry[1]:  # Touched, but not changed
+                entry = self._tables[key] = (stamp, digest, entry[2])
+            else:
+                entry = None
+                self.reloads += 1
+        if entry is None:
+            table = reader(path, *args)
+            entry = self._tables[key] = (stamp, file_hash(path), table)
+        return entry[2]
+
+
+#
+# i2b2 ICD code map: "dbGaP_" + code -> concept path, with the commas in
+# the path already replaced for the concepts file
+#
+def load_icd_codes(codefile):
+    icd_codes = {}
+    comma = re.compile(r",\s?")
+    with open(codefile) as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            key = row[-1]
+            val = ",".join(row[:-1])
+            icd_codes["dbGaP_" + key] = comma.sub(" - ", val)
+    return icd_codes
+
+
+# Visit number -> visit date; the first row wins
+def load_visit_dates(file):
+    visit_dates = {}
+    with open(file, "r", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        next(reader, None)  # VISNO,Date,Description
+        for row in reader:
+            if len(row) < 2 or row[0] in visit_dates:
+                continue
+            if row[1] == "":
+                visit_dates[row[0]] = None
+            else:
+                visit_dates[row[0]] = datetime.datetime.strptime(
+                    row[1], "%m-%d-%Y"
+                )
+    return visit_dates
+
+
+#
+# Demographics file mapping dbGaP codes to i2b2 demographic codes,
+# indexed by dbGaP code (column 2) and by race code and ethnicity
+# (columns 2 and 6). The Demographic_field and Another_field prefixes
+# (columns 3 and 7) are kept in sets by prefix length.
+#
+def load_demographics(file):
+    with open(file, "r", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        demographics = list(reader)
+
+    demographic_codes = {}
+    ethnicity_codes = {}
+    demographic_prefixes = {}
+    first_rows = {}
+    for row in demographics:
+        first_rows.setdefault(row[2], row)
+        # The last row with the race code and ethnicity wins
+        ethnicity_codes[(row[2], row[6])] = row[1]
+        for prefix in (row[3], row[7]):
+            if prefix != "":
+                demographic_prefixes.setdefault(len(prefix), set()).add(prefix)
+    for code, row in first_rows.items():
+        # column 6 is ethnicity and should be empty except for race
+        if row[6] == "":
+            demographic_codes[code] = row[1]  # get i2b2 DEM code
+    return demographic_codes, ethnicity_codes, demographic_prefixes
+
+
+#
+# Statistics of a run for --stats: time spent in each stage, counters of
+# rows, cells and facts, and progress reports with an ETA
+#
+class RunStats:
+    def __init__(self, name, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.interval = interval  # None: no progress reports
+        self.stages = {}  # stage -> seconds
+        self.counters = Counter()
+        self._stage = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._stage = name
+        self._stage_start = self._last_report = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - self._stage_start
+            self.stages[name] = self.stages.get(name, 0) + seconds
+            self._stage = None
+
+    #
+    # Items of an iterable, reporting progress every interval seconds.
+    # Progress is the number of items or, with position, a position out
+    # of total, e.g. a byte offset in the input file.
+    #
+    def track(self, items, total=None, position=None):
+        for done, item in enumerate(items, 1):
+            yield item
+            if self.interval is not None:
+                self.progress(position() if position else done, total)
+
+    def progress(self, done, total=None):
+        now = time.perf_counter()
+        if now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        elapsed = now - self._stage_start
+        if total and done:
+            eta = elapsed * (total - done) / done
+            print(
+                f"{self.name}: {self._stage}: {done / total:.1%} done in "
+                f"{elapsed:.0f}s, ETA {eta:.0f}s",
+                flush=True,
+            )
+        else:
+            print(
+                f"{self.name}: {self._stage}: {done} done in {elapsed:.0f}s",
+                flush=True,
+            )
+
+    def report(self):
+        print(f"{self.name}: stage timings")
+        for stage, seconds in self.stages.items():
+            print(f"  {stage:24} {seconds:10.2f}s")
+        print(f"  {'total':24} {sum(self.stages.values()):10.2f}s")
+        print(f"{self.name}: counters")
+        for name, count in sorted(self.counters.items()):
+            print(f"  {name:24} {count:10}")
+
+
+#
+# Facts held in memory for --compact, dictionary-encoded: every distinct
+# mrn, start date, code and value is stored once per column, and a fact is
+# four integer ids in arrays instead of a tuple of four strings. Iterating
+# yields the facts as tuples in the order they were added.
+#
+class FactTable:
+    __slots__ = ("_ids", "_columns")
+
+    def __init__(self):
+        self._ids = tuple({} for _ in range(4))  # string -> id, in id order
+        self._columns = tuple(array("I") for _ in range(4))
+
+    def extend(self, facts):
+        for ids, column, items in zip(self._ids, self._columns, zip(*facts)):
+            # The id of a new string is the size of ids when it is added
+            column.extend(map(ids.setdefault, items, map(len, repeat(ids))))
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __iter__(self):
+        return zip(
+            *(
+                map(list(ids).__getitem__, column)
+                for ids, column in zip(self._ids, self._columns)
+            )
+        )
 
 
 class ETLdbGap:
-    def __init__(self, config):
+    def __init__(self, config, references=None, stats=None):
         self.config = config
+        self._references = references or ReferenceTables()
+        self.stats = stats  # RunStats or None
         self._data_dictionary = []
         self._map_phenotype_to_concept = []
+        self._concepts = None  # Rows of the concepts file
+        self._concept_index = {}  # (varname, dbgap_code_id) -> i2b2code
+        self._default_codes = {}  # varname -> i2b2code when no code matches
         self._data = []
         self._variables = {}
         self._icd_codes = {}  # All ICD codes and paths
         self._icd_vars = []  # Code types in DD (ICD-9 and/or ICD-10)
-        self._used_icd_codes = []  # codes actually in use
+        self._used_icd_codes = Counter()  # codes in use, in order of use
+        self.duplicate_facts = 0  # Facts dropped by --dedup
         self.codeprefix = ""
         if "codeprefix" in self.config:
             self.codeprefix = self.config["codeprefix"]
+        self._include_vars = var_patterns(config, "include_vars")
+        self._exclude_vars = var_patterns(config, "exclude_vars")
+
+    # Time a stage of the run when keeping stats
+    def stage(self, name):
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.stage(name)
+
+    def track(self, items, total=None, position=None):
+        if self.stats is None:
+            return items
+        return self.stats.track(items, total, position)
 
     def read_icd_codes(self, codefile):
-        with open(codefile) as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                key = row[-1]
-                val = ",".join(row[:-1])
-                self._icd_codes["dbGaP_" + key] = val
+        self._icd_codes = self._references.load(load_icd_codes, codefile)
         return len(self._icd_codes)
 
     def icd_codes(self):
@@ -52,15 +329,10 @@ class ETLdbGap:
     # The AREDS dictionaries may have leading comment lines
     #
     def read_areds_data_dictionary(self, dictfile):
-        with open(dictfile, encoding="latin-1") as csvfile:
-            ptr = csvfile.tell()
-            line = csvfile.readline()
+        with open_file(dictfile, encoding="latin-1") as csvfile:
             # Skip leading comment lines
-            while line.startswith("!#!"):
-                ptr = csvfile.tell()
-                line = csvfile.readline()
-            csvfile.seek(ptr)
-            reader = csv.DictReader(csvfile)
+            lines = dropwhile(lambda line: line.startswith("!#!"), csvfile)
+            reader = csv.DictReader(lines)
             for row in reader:
                 # Skip empty lines
                 if list(row.values())[0]:
@@ -86,29 +358,51 @@ class ETLdbGap:
                 )
             else:
                 file = self.config["visitdatefile"]
-                with open(file, "r", encoding="utf-8-sig") as file:
-                    reader = csv.reader(file)
-                    self._visitdatefile = list(reader)
+                self._visit_dates = self._references.load(
+                    load_visit_dates, file
+                )
 
-    # For studies with visit numbers that map to a date
     def read_demographics_file(self):
         if "demographics_file" in self.config:
             try:
                 file = self.config["demographics_file"]
-                with open(file, "r", encoding="utf-8-sig") as file:
-                    reader = csv.reader(file)
-                    self._demographics_file = list(reader)
+                (
+                    self._demographic_codes,
+                    self._ethnicity_codes,
+                    self._demographic_prefixes,
+                ) = self._references.load(load_demographics, file)
 
             except KeyError:
                 print("Error: demographics_file cannot be opened!")
 
+    #
+    # Is the variable selected by the include_vars and exclude_vars
+    # patterns of the config? Variables that are not get neither concepts
+    # nor facts.
+    #
+    def selected_var(self, varname):
+        if self._include_vars and not any(
+            pattern.fullmatch(varname) for pattern in self._include_vars
+        ):
+            return False
+        return not any(
+            pattern.fullmatch(varname) for pattern in self._exclude_vars
+        )
+
+    # Does the code start with a Demographic_field or Another_field?
+    def is_demographic_code(self, code):
+        for length, prefixes in self._demographic_prefixes.items():
+            if code[:length] in prefixes:
+                return True
+        return False
+
     #
     # The AREDS2 dictionaries have enumerated values separated by commas;
     # some values use = to separate codes, others do not.
     #
     def read_areds2_data_dictionary(self, dictfile):
-        if dictfile.endswith(".txt"):
-            with open(dictfile, "r", encoding="latin1") as csvfile:
+        if uncompressed_name(dictfile).endswith(".txt"):
+            with open_file(dictfile, "r", encoding="latin1") as csvfile:
                 #
                 # Read headers explicitly and let DictReader make a list of
                 # the enumerated values
@@ -135,7 +429,7 @@ class ETLdbGap:
 
                         self._data_dictionary.append(row)
         else:
-            with open(dictfile, "r", encoding="utf-8-sig") as csvfile:
+            with open_file(dictfile, "r", encoding="utf-8-sig") as csvfile:
                 #
                 # Read headers explicitly and let DictReader make a list of
                 # the enumerated values
@@ -151,12 +445,23 @@ class ETLdbGap:
                     if list(row.values())[0]:
                         self._data_dictionary.append(row)
 
-    def write_concepts(self, conceptsfile):
+    #
+    # Concepts of the data dictionary: fills _map_phenotype_to_concept and
+    # its index, and keeps the (conceptpath, i2b2code, i2b2vartype) rows of
+    # the concepts file in _concepts
+    #
+    def map_concepts(self):
         split_data = []
+        self._map_phenotype_to_concept = []
+        self._icd_vars = [
+            var for var in self._icd_vars if self.selected_var(var)
+        ]
         for row in self._data_dictionary:
             varname = row[self.config["varname"]]
             if varname == self.config["patientid"]:
                 continue
+            if not self.selected_var(varname):
+                continue
             vartype = row[self.config["typename"]]
             enums = row[self.config["enumname"]]
 
@@ -296,73 +601,246 @@ class ETLdbGap:
                             varname,
                         )
                     )
+        self.index_concepts()
+        self._concepts = split_data
+
+    #
+    # Cache of the parsed data dictionary and its concepts in cachedir, keyed
+    # by the hash of the dictionary file and the config keys they depend on
+    #
+    def concept_cache_file(self, dictfile, cachedir):
+        key = json.dumps(
+            [
+                CONCEPT_CACHE_VERSION,
+                file_hash(dictfile),
+                [self.config.get(name) for name in CONCEPT_CONFIG_KEYS],
+            ]
+        )
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(cachedir, digest + ".pickle")
+
+    #
+    # Load the concepts of dictfile from the cache; False if not cached. An
+    # entry that cannot be unpickled, whatever the error, counts as not
+    # cached and is written again.
+    #
+    def load_concepts(self, dictfile, cachedir):
+        try:
+            with open(self.concept_cache_file(dictfile, cachedir), "rb") as f:
+                cached = pickle.load(f)
+            if cached[0] != CONCEPT_CACHE_VERSION:
+                return False
+            self.restore_concepts(cached[1:])
+        except Exception:
+            return False
+        return True
+
+    # Every writer has a temporary file of its own, so that concurrent
+    # jobs saving the same entry do not truncate each other's file
+    def save_concepts(self, dictfile, cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+        path = self.concept_cache_file(dictfile, cachedir)
+        cached = (CONCEPT_CACHE_VERSION,) + self.concept_state()
+        fd, tmppath = tempfile.mkstemp(suffix=".tmp", dir=cachedir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+    #
+    # Concepts of dictfile from the reference tables, which parse every
+    # dictionary once per config keys of CONCEPT_CONFIG_KEYS
+    #
+    def reference_concepts(self, dictfile):
+        key = json.dumps(
+            [
+                [name, self.config[name]]
+                for name in CONCEPT_CONFIG_KEYS
+                if name in self.config
+            ],
+            default=str,
+        )
+        self.restore_concepts(
+            self._references.load(parse_concepts, dictfile, key)
+        )
+
+    # The parsed data dictionary and its concepts
+    def concept_state(self):
+        return (
+            self._icd_vars,
+            self._map_phenotype_to_concept,
+            self._concepts,
+            self._concept_index,
+            self._default_codes,
+            self._enumerated_vars,
+        )
+
+    def restore_concepts(self, state):
+        (
+            self._icd_vars,
+            self._map_phenotype_to_concept,
+            self._concepts,
+            self._concept_index,
+            self._default_codes,
+            self._enumerated_vars,
+        ) = state
+
+    def write_concepts(self, conceptsfile, format="csv"):
+        rows = self.concept_rows()
+        if format != "csv":
+            write_table(conceptsfile, format, CONCEPT_COLUMNS, rows)
+            return
         with open(conceptsfile, "w", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(["path", "code", "type"])
-            for row in split_data:
-                skip = False
-                if "demographics_file" in self.config:
-                    # Are we using i2b2 demographic codes? If so, then skip
-                    #  row[]=(conceptpath, i2b2code, i2b2vartype)
-                    code = row[1]
-                    for i, demrow in enumerate(self._demographics_file):
-                        if (
-                            demrow[3] != "" and code.startswith(demrow[3])
-                        ) or (
-                            demrow[7] != "" and code.startswith(demrow[7])
-                        ):  # "Skip"
-                            skip = True
-                            break
-
-                    if not skip:
-                        format = self.config["dictformat"]
-                        if format == "areds":  # AREDS
-                            if code.startswith("ENROLLAGE"):  # Age
-                                skip = True
-                        else:  # AREDS 2, Test
-                            if code.startswith("AGE") or code.startswith(
-                                "ICD9"
-                            ):
-                                skip = True
+            writer.writerow(CONCEPT_COLUMNS)
+            writer.writerows(rows)
+
+    # (path, code, type) rows of the concepts file
+    def concept_rows(self):
+        if self._concepts is None:
+            self.map_concepts()
+        rows = []
+        for row in self._concepts:
+            skip = False
+            if "demographics_file" in self.config:
+                # Are we using i2b2 demographic codes? If so, then skip
+                #  row[]=(conceptpath, i2b2code, i2b2vartype)
+                code = row[1]
+                if self.is_demographic_code(code):  # "Skip"
+                    skip = True
 
                 if not skip:
-                    listconcepts = list(row)
-                    listconcepts[1] = self.codeprefix + listconcepts[1]
-                    writer.writerow(listconcepts)
-
-    def write_icd_concepts(self, conceptsfile):
-        for varname in self._icd_vars:
-            # i = self._data[0].index(varname)
-            with open(conceptsfile, "w", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(["path", "code", "type"])
-
-                for key in self._used_icd_codes:
-                    # base = re.sub("/[^/]+$", "", self.config["pathroot"]) # Use when adding a path prefix oither than the standard one
-                    try:
-                        # path = "/" + base + self._icd_codes[key]
-
-                        path = self._icd_codes[key]
-                        path = re.sub(",\s?", " - ", path)
-                    except KeyError:
-                        continue
-                    writer.writerow([path, key, "assertion"])
-        return
+                    format = self.config["dictformat"]
+                    if format == "areds":  # AREDS
+                        if code.startswith("ENROLLAGE"):  # Age
+                            skip = True
+                    else:  # AREDS 2, Test
+                        if code.startswith("AGE") or code.startswith("ICD9"):
+                            skip = True
 
-    def read_facts(self, phenocsvfile):
-        self._data = []
-        if phenocsvfile.endswith(".txt"):
-            with open(phenocsvfile, "r", encoding="latin1") as f:
-                reader = csv.reader(f, delimiter="\t")
-                self._data = list(reader)
+            if not skip:
+                rows.append((row[0], self.codeprefix + row[1], row[2]))
+        return rows
+
+    #
+    # Index _map_phenotype_to_concept so that collect_facts resolves a cell
+    # with a dictionary lookup instead of scanning every concept. The index
+    # reproduces the linear scan: the first (varname, dbgap_code_id) match
+    # wins, but since a match blanks the value, a later concept of the same
+    # variable with an empty code id overrides it. The default code of a
+    # variable is the last concept with that varname.
+    #
+    def index_concepts(self):
+        self._concept_index = {}
+        self._default_codes = {}
+        self._enumerated_vars = set()  # variables with encoded values
+        blank_codes = {}  # varname -> (position, i2b2code) of empty code id
+        for x, concept in enumerate(self._map_phenotype_to_concept):
+            _, i2b2code, _, dbgap_code_id, varname = concept
+            self._concept_index.setdefault(
+                (varname, dbgap_code_id), (x, i2b2code)
+            )
+            self._default_codes[varname] = i2b2code
+            if dbgap_code_id not in (-1, ""):
+                self._enumerated_vars.add(varname)
+            if dbgap_code_id == "":
+                blank_codes[varname] = (x, i2b2code)
+        for key, (x, i2b2code) in self._concept_index.items():
+            blank = blank_codes.get(key[0])
+            if blank is not None and blank[0] > x:
+                i2b2code = blank[1]
+            self._concept_index[key] = i2b2code
+
+    def write_icd_concepts(self, conceptsfile, format="csv"):
+        if not self._icd_vars:
+            return
+        if format != "csv":
+            write_table(
+                conceptsfile, format, CONCEPT_COLUMNS, self.icd_concept_rows()
+            )
+            return
+        with open(conceptsfile, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CONCEPT_COLUMNS)
+            writer.writerows(self.icd_concept_rows())
+
+    # One concept per ICD code used by the facts, in order of first use
+    def icd_concept_rows(self):
+        rows = []
+        for key in self._used_icd_codes:
+            # base = re.sub("/[^/]+$", "", self.config["pathroot"]) # Use when adding a path prefix oither than the standard one
+            # path = "/" + base + self._icd_codes[key]
+            path = self._icd_codes.get(key)
+            if path is not None:
+                rows.append((path, key, "assertion"))
+        return rows
+
+    # Encoding and delimiter of a phenotype file
+    def facts_format(self, phenocsvfile):
+        if uncompressed_name(phenocsvfile).endswith(".txt"):
+            return "latin1", "\t"
+        else:
+            return "utf-8-sig", ","
+
+    def open_facts(self, phenocsvfile):
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        f = open_file(phenocsvfile, "r", encoding=encoding)
+        return f, csv.reader(f, delimiter=delimiter)
+
+    # ICD codes used by a facts file written earlier, in fact order
+    def read_used_icd_codes(self, factsfile):
+        if uncompressed_name(factsfile).endswith(OUTPUT_SUFFIXES["csv"]):
+            # CSV facts files are counted as they are read
+            f = open_file(factsfile, "r", newline="")
+            reader = csv.reader(f)
+            next(reader, None)  # Header
+            codes = (row[2] for row in reader)
         else:
-            with open(phenocsvfile, "r", encoding="utf-8-sig") as f:
-                reader = csv.reader(f)
-                self._data = list(reader)
+            f = contextlib.nullcontext()
+            codes = read_table(factsfile, "code")
+        with f:
+            for code in codes:
+                if code.startswith("dbGaP_ICD"):
+                    self._used_icd_codes[code] += 1
+
+    def read_facts(self, phenocsvfile):
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        self._data = PhenotypeFile(phenocsvfile, encoding, delimiter)
+        self.read_header(self._data.header)
+
+    #
+    # Column lookups for the phenotype file, shared by the in-memory and
+    # the streaming fact pipelines
+    #
+    def read_header(self, header):
+        self._header = header
+        self._variables = {}
         i = 0
-        while i < len(self._data[0]):
-            self._variables[self._data[0][i]] = i
+        while i < len(header):
+            self._variables[header[i]] = i
             i += 1
+        self._patient_column = self._variables[self.config["patientid"]]
+        # Should skip time variables
+        if self.config["datemode"] == 2:
+            skiplist = list(self.config["timevar"].keys())
+        else:
+            skiplist = []
+        self._skip_columns = {
+            j
+            for j, varname in enumerate(header)
+            if j == self._patient_column
+            or varname in skiplist
+            or not self.selected_var(varname)
+        }
+        # Columns whose cells become facts
+        self._fact_columns = [
+            j for j in range(len(header)) if j not in self._skip_columns
+        ]
+        self._prevcode = ""
+        self.compile_fact_time()
 
     def add_time(self, visitdateformat, beginDate, timediff):
         startdate = beginDate
@@ -383,31 +861,17 @@ class ETLdbGap:
 
     def add_demographics(self, code, value, raceCodeAreds2):
         i2b2demcode = ""
-        i2b2ethnicity = ""
 
-        # Go through demographics file and find the code
+        # Look up the code in the demographics file
         if "demographics_file" in self.config:
             if code.startswith(
                 "ETHNIC"
             ):  # Areds2 has ethnicty and race separate
-                matching_rows = [
-                    row
-                    for row in self._demographics_file
-                    if row[2] == raceCodeAreds2
-                ]
-                for row in matching_rows:
-                    i2b2ethnicity = row[6]  # get i2b2 ethnicity
-                    if i2b2ethnicity == code:
-                        i2b2demcode = row[1]
-            else:
-                matching_row = next(
-                    (row for row in self._demographics_file if row[2] == code),
-                    None,
+                i2b2demcode = self._ethnicity_codes.get(
+                    (raceCodeAreds2, code), ""
                 )
-                if (
-                    matching_row is not None and matching_row[6] == ""
-                ):  # column 6 is ethnicity and should be empty except for race
-                    i2b2demcode = matching_row[1]  # get i2b2 DEM code
+            else:
+                i2b2demcode = self._demographic_codes.get(code, "")
 
         format = self.config["dictformat"]
         if format == "areds":  # AREDS
@@ -434,281 +898,2380 @@ class ETLdbGap:
     # using a regex, e.g. F04, for 4 monrths visit
     # Mode 6: Use Visno file. Example AREDS2_rcf.yml
     # Mode 7:  visit is calculated by a time difference as a integer (parsable within a string). Example ACCORD_f34.yml
-    def fact_time(self, i, j):
+    def fact_time(self, row, j):
+        return self._time_resolvers[self._column_times[j]](row)
+
+    #
+    # Compile the datemode logic once per input file. Every column gets a
+    # key into _time_resolvers, a function that computes the timestamp of a
+    # row; columns that share a timestamp share a key, so row_facts
+    # evaluates each resolver at most once per row. _time_columns lists the
+    # columns the resolvers read, when known.
+    #
+    def compile_fact_time(self):
         visitbaselinedate = self.config["basedate"]
         visitdateformat = int(self.config["dateformat"])
         beginDate = datetime.datetime.strptime(visitbaselinedate, "%d/%m/%Y")
-        if int(self.config["datemode"]) == 0:
-            return beginDate.strftime("%Y-%m-%d")
-        varname = list(self._variables.keys())[
-            list(self._variables.values()).index(j)
-        ]
-        if (self.config["datemode"]) == 1:  # Deprecated, see Mode = 5
+        basedate = beginDate.strftime("%Y-%m-%d")
+        datemode = self.config["datemode"]
+        self._column_times = [None] * len(self._header)
+        self._time_resolvers = {None: lambda row: None}
+        self._time_columns = []
+
+        def add_time(beginDate, timediff):
+            return self.add_time(visitdateformat, beginDate, timediff)
+
+        if int(datemode) == 0:
+            self._column_times = [0] * len(self._header)
+            self._time_resolvers[0] = lambda row: basedate
+        elif datemode == 1:  # Deprecated, see Mode = 5
             defaulttimevar = self.config["timevar"]["default"]
-            # Is there a specific time variable for this variable?
-            try:
-                self.config["timevar"][varname]
-            except KeyError:
-                timevar = defaulttimevar
-            else:
-                timevar = self.config["timevar"][varname]
+            self._time_columns = None
 
-            if self._data[i][self._variables[timevar]].isalnum():
-                timediff = float(self._data[i][self._variables[timevar]])
-            else:
-                timediff = float(
-                    self._data[i][self._variables[defaulttimevar]]
+            def resolver(timevar):
+                def fact_time(row):
+                    if row[self._variables[timevar]].isalnum():
+                        timediff = float(row[self._variables[timevar]])
+                    else:
+                        timediff = float(row[self._variables[defaulttimevar]])
+                    return add_time(beginDate, timediff).strftime("%Y-%m-%d")
+
+                return fact_time
+
+            for j, varname in enumerate(self._header):
+                # Is there a specific time variable for this variable?
+                timevar = self.config["timevar"].get(varname, defaulttimevar)
+                self._column_times[j] = timevar
+                self._time_resolvers[timevar] = resolver(timevar)
+        elif datemode == 2:
+            timevars = [
+                (self._variables[tv], re.compile(tvre))
+                for tv, tvre in self.config["timevar"].items()
+            ]
+            self._time_columns = [i for i, _ in timevars]
+
+            def startdates(row, n):
+                for i, _ in timevars[:n]:
+                    if row[i] == "":
+                        timediff = 0
+                    else:
+                        timediff = float(row[i])
+                    yield add_time(beginDate, timediff)
+
+            def resolver(k):
+                def fact_time(row):
+                    startdate = list(startdates(row, k + 1))[-1]
+                    return startdate.strftime("%Y-%m-%d")
+
+                return fact_time
+
+            def latest(row):
+                if len(timevars):
+                    laststartdate = max(startdates(row, len(timevars)))
+                    return laststartdate.strftime("%Y-%m-%d")
+                else:
+                    return -1
+
+            self._time_resolvers["max"] = latest
+            for j, varname in enumerate(self._header):
+                self._column_times[j] = "max"
+                for k, (_, tvre) in enumerate(timevars):
+                    if tvre.search(varname):
+                        self._column_times[j] = k
+                        self._time_resolvers[k] = resolver(k)
+                        break
+                # else: no matching time, use the latest one
+        elif datemode in (3, 4):
+            defaulttime = self._variables[self.config["timevar"]["default"]]
+            addltimes = [
+                self._variables[tv] for tv in self.config["additionaltimevar"]
+            ]
+            self._time_columns = [defaulttime] + addltimes
+            if datemode == 3:
+                additionaldatedifftimeunits = int(
+                    self.config["additionaldatedifftimeunits"]
                 )
 
-            startdate = self.add_time(visitdateformat, beginDate, timediff)
-            return startdate.strftime("%Y-%m-%d")
-        elif (self.config["datemode"]) == 2:
-            startdates = []
-            for tv in self.config["timevar"]:
-                tvre = self.config["timevar"][tv]
-                if self._data[i][self._variables[tv]] == "":
-                    timediff = 0
+            def fact_time(row):
+                timediff = float(row[defaulttime])
+                addltime = 0
+                for i in addltimes:
+                    if row[i].isnumeric():
+                        addltime = max(addltime, int(row[i]))
+                if datemode == 3:
+                    startdate = add_time(beginDate, timediff)
+                    startdate = self.add_time(
+                        additionaldatedifftimeunits, startdate, addltime
+                    )
                 else:
-                    timediff = float(self._data[i][self._variables[tv]])
-                startdate = self.add_time(visitdateformat, beginDate, timediff)
-                if re.search(tvre, self._data[0][j]):
-                    return startdate.strftime("%Y-%m-%d")
-                startdates.append(startdate)
+                    timediff = max(timediff, addltime)
+                    startdate = add_time(beginDate, timediff)
+                return startdate.strftime("%Y-%m-%d")
+
+            self._column_times = [0] * len(self._header)
+            self._time_resolvers[0] = fact_time
+        elif datemode in (5, 7):
+            datevar = self._variables[self.config["timevar"]["default"]]
+            self._time_columns = [datevar]
+            if datemode == 5:  # float time difference
+                timeregex = re.compile(r"^[+-]?((\d+(\.\d+)?)|(\.\d+))$")
+                timetype = float
+            else:  # ACCORD_f34
+                timeregex = re.compile(r"\d+")
+                timetype = int
+
+            def fact_time(row):
+                timediff = 0
+                match = timeregex.search(row[datevar])
+                if match:
+                    timediff = timetype(match.group())
+                startdate = add_time(beginDate, timediff)
+                return startdate.strftime("%Y-%m-%d")
+
+            self._column_times = [0] * len(self._header)
+            self._time_resolvers[0] = fact_time
+        elif datemode == 6:
+            datevar = self._variables[self.config["timevar"]["default"]]
+            self._time_columns = [datevar]
+
+            def fact_time(row):
+                visitdate = self._visit_dates.get(row[datevar])
+                if visitdate is None:
+                    if self.stats is not None:
+                        self.stats.counters["visit_date_misses"] += 1
+                    print(
+                        "Error: did not find visit number in visit date file"
+                    )
+                    return basedate
+                return visitdate.strftime("%Y-%m-%d")
+
+            self._column_times = [0] * len(self._header)
+            self._time_resolvers[0] = fact_time
+
+    def collect_facts(self, compact=False):
+        facts = FactTable() if compact else []
+        self._prevcode = ""
+        for row in self.track(self._data.rows(), len(self._data)):
+            facts.extend(self.row_facts(row))
+        return facts
+
+    #
+    # Streaming alternative to read_facts + collect_facts: the phenotype
+    # file is read row by row and facts are yielded as they are generated,
+    # so neither the input nor the facts are held in memory
+    #
+    def stream_facts(self, phenocsvfile):
+        for row in self.stream_rows(phenocsvfile):
+            yield from self.row_facts(row)
+
+    #
+    # Pipelined alternative to stream_facts for --pipeline: a thread reads
+    # and decodes blocks of rows ahead of the rows whose facts are generated
+    #
+    def pipeline_facts(self, phenocsvfile):
+        if is_compressed(phenocsvfile):
+            # Compressed inputs are streamed instead of mapped
+            blocks = pipelined(batched(self.stream_rows(phenocsvfile)))
+            for block in blocks:
+                for row in block:
+                    yield from self.row_facts(row)
+            return
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        with PhenotypeFile(phenocsvfile, encoding, delimiter) as data:
+            self.read_header(data.header)
+            rows = (row for block in pipelined(data.blocks()) for row in block)
+            for row in self.track(rows, len(data)):
+                yield from self.row_facts(row)
 
-            # print(f"No matching time for: {self._data[0][j]!r}")
-            if len(startdates):
-                laststartdate = max(startdates)
-                return laststartdate.strftime("%Y-%m-%d")
+    def stream_rows(self, phenocsvfile):
+        f, reader = self.open_facts(phenocsvfile)
+        with f:
+            self.read_header(next(reader))
+            if is_compressed(phenocsvfile):
+                yield from self.track(reader)
             else:
-                return -1
-        elif (self.config["datemode"]) == 3:
-            defaulttimevar = self.config["timevar"]["default"]
-            addltimevars = self.config["additionaltimevar"]
-            timediff = float(self._data[i][self._variables[defaulttimevar]])
-            addltime = 0
-            for tv in addltimevars:
-                if self._data[i][self._variables[tv]].isnumeric():
-                    timeval = int(self._data[i][self._variables[tv]])
-                    addltime = max(addltime, timeval)
-            additionaldatedifftimeunits = int(
-                self.config["additionaldatedifftimeunits"]
+                size = os.fstat(f.fileno()).st_size
+                yield from self.track(reader, size, f.buffer.tell)
+
+    #
+    # Columnar engine: the same facts as stream_facts, in the same order,
+    # computed with pandas and NumPy on blocks of rows. Cells are factorized
+    # per column, so codes are looked up once per distinct value, and each
+    # block is melted into one fact per non-empty cell in row-major order.
+    # Codes are carried as integer ids into a table of all i2b2 codes, and
+    # each timestamp is computed once per row.
+    #
+    def columnar_facts(self, phenocsvfile, chunksize=None):
+        for mrns, times, codes, values in self.columnar_blocks(
+            phenocsvfile, chunksize
+        ):
+            yield from zip(
+                mrns.tolist(), times.tolist(), codes.tolist(), values.tolist()
             )
-            startdate = self.add_time(visitdateformat, beginDate, timediff)
-            startdate = self.add_time(
-                additionaldatedifftimeunits, startdate, addltime
+
+    # The facts of columnar_facts as blocks of arrays of mrns, times, codes
+    # and values
+    def columnar_blocks(self, phenocsvfile, chunksize=None):
+        import_pandas()
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        with open_file(phenocsvfile, "r", encoding=encoding) as f:
+            self.read_header(next(csv.reader(f, delimiter=delimiter)))
+        ncolumns = len(self._header)
+        if chunksize is None:
+            chunksize = max(1, COLUMNAR_BLOCK_CELLS // ncolumns)
+        columns = [j for j in range(ncolumns) if j not in self._skip_columns]
+        timekeys = {}
+        for j in columns:
+            timekeys.setdefault(self._column_times[j], []).append(j)
+
+        # Table of codes; ids are positions in the table
+        code_ids = {}
+
+        def code_id(code):
+            return code_ids.setdefault(code, len(code_ids))
+
+        # Enumerated code ids of each column: dbgap_code_id -> id
+        enums = {varname: {} for varname in self._header}
+        for (varname, dbgap_code_id), code in self._concept_index.items():
+            if varname in enums:
+                enums[varname][dbgap_code_id] = code_id(code)
+        default_ids = {
+            varname: code_id(self._default_codes.get(varname, "-"))
+            for varname in self._header
+        }
+        demographics = "demographics_file" in self.config
+        if self.config.get("dictformat") == "areds":
+            agecode = "ENROLLAGE"
+        else:
+            agecode = "AGE"
+
+        with open_file(phenocsvfile, "rb") as f:
+            size = position = None  # Unknown for compressed inputs
+            if not is_compressed(phenocsvfile):
+                size, position = os.path.getsize(phenocsvfile), f.tell
+            blocks = pd.read_csv(
+                f,
+                sep=delimiter,
+                encoding=encoding,
+                header=None,
+                skiprows=1,
+                names=range(ncolumns),
+                dtype=object,
+                na_filter=False,
+                chunksize=chunksize,
             )
-            return startdate.strftime("%Y-%m-%d")
-        elif (self.config["datemode"]) == 4:
-            defaulttimevar = self.config["timevar"]["default"]
-            addltimevars = self.config["additionaltimevar"]
-            timediff = float(self._data[i][self._variables[defaulttimevar]])
-            addltime = 0
-            for tv in addltimevars:
-                if self._data[i][self._variables[tv]].isnumeric():
-                    timeval = int(self._data[i][self._variables[tv]])
-                    addltime = max(addltime, timeval)
-            timediff = max(timediff, addltime)
-            startdate = self.add_time(visitdateformat, beginDate, timediff)
-            return startdate.strftime("%Y-%m-%d")
-        elif (self.config["datemode"]) == 5:  # float time difference
-            datevar = self.config["timevar"]["default"]
-            timediff = 0
-            visitval = self._data[i][self._variables[datevar]]
-            match = re.search(r"^[+-]?((\d+(\.\d+)?)|(\.\d+))$", visitval)
-            if match:
-                timediff = float(match.group())
-            # timediff = float (visitval)
-            startdate = self.add_time(visitdateformat, beginDate, timediff)
-            return startdate.strftime("%Y-%m-%d")
-        elif (self.config["datemode"]) == 6:
-            datevar = self.config["timevar"]["default"]
-            visitval = self._data[i][self._variables[datevar]]
-            visno_date = ""
-            for i, row in enumerate(self._visitdatefile):
-                if row[0] == visitval:
-                    visno_date = row[1]
-                    break
-            if visno_date == "":
-                print("Error: did not find visit number in visit date file")
-            else:
-                beginDate = datetime.datetime.strptime(visno_date, "%m-%d-%Y")
-            return beginDate.strftime("%Y-%m-%d")
-        elif (self.config["datemode"]) == 7:  # ACCORD_f34
-            datevar = self.config["timevar"]["default"]
-            timediff = 0
-            visitval = self._data[i][self._variables[datevar]]
-            match = re.search(r"\d+", visitval)
-            if match:
-                timediff = int(match.group())
-            startdate = self.add_time(visitdateformat, beginDate, timediff)
-            return startdate.strftime("%Y-%m-%d")
-
-    def collect_facts(self):
-        facts = []
-        code = ""
-        value = ""
-        dt_string = ""
-        prevcode = ""
-        for i in range(len(self._data)):
-            if i > 0:
-                # Patient ID
-                mrn = self._data[i][self._variables[self.config["patientid"]]]
-
-                # Loop through cells in row
-                # Should skip time variables
-                if self.config["datemode"] == 2:
-                    skiplist = list(self.config["timevar"].keys())
-                #                elif self.config["datemode"] == 0:
-                else:
-                    skiplist = []
-                #                else:
-                #                    skiplist = list(self.config["timevar"].values())
-                for j, value in enumerate(self._data[i]):
-                    varname = list(self._variables.keys())[
-                        list(self._variables.values()).index(j)
-                    ]
-                    if (
-                        j == self._variables[self.config["patientid"]]
-                        or self._data[i][j].strip() == ""
-                        or varname in skiplist
-                    ):
+            counters = self.stats.counters if self.stats is not None else None
+            for block in self.track(blocks, size, position):
+                cells = block.fillna("").to_numpy(dtype=object)
+                present = np.zeros(cells.shape, dtype=bool)
+                ids = np.zeros(cells.shape, dtype=np.int64)
+                values = cells.copy()
+                for j in columns:
+                    labels, uniques = pd.factorize(cells[:, j])
+                    varname = self._header[j]
+                    enum = enums[varname]
+                    present[:, j] = np.array(
+                        [value.strip() != "" for value in uniques], dtype=bool
+                    )[labels]
+                    unique_ids = np.array(
+                        [enum.get(value, -1) for value in uniques],
+                        dtype=np.int64,
+                    )[labels]
+                    enumerated = unique_ids >= 0
+                    ids[:, j] = np.where(
+                        enumerated, unique_ids, default_ids[varname]
+                    )
+                    values[enumerated, j] = ""
+                    if counters is None:
                         continue
+                    if varname not in self._default_codes:
+                        counters["unknown_variables"] += int(
+                            present[:, j].sum()
+                        )
+                    elif varname in self._enumerated_vars:
+                        counters["lookup_misses"] += int(
+                            (present[:, j] & ~enumerated).sum()
+                        )
+                if counters is not None:
+                    counters["rows"] += len(cells)
+                    counters["cells"] += cells.size
+                    counters["cells_skipped"] += cells.size - int(
+                        present.sum()
+                    )
+
+                # One timestamp per row and time key, for rows that need it,
+                # computed once per distinct combination of time cells
+                times = np.empty(cells.shape, dtype=object)
+                for timekey, keycolumns in timekeys.items():
+                    resolver = self._time_resolvers[timekey]
+                    rows = np.flatnonzero(present[:, keycolumns].any(axis=1))
+                    if self._time_columns is None:
+                        timecells = rows.tolist()
                     else:
-                        if self._data[i][j].strip() == "":
-                            continue
+                        timecells = map(
+                            tuple, cells[rows][:, self._time_columns].tolist()
+                        )
+                    rowtimes = np.empty(len(rows), dtype=object)
+                    memo = {}
+                    for n, (i, key) in enumerate(zip(rows, timecells)):
+                        rowtime = memo.get(key)
+                        if rowtime is None:
+                            rowtime = memo[key] = str(resolver(cells[i]))
+                        rowtimes[n] = rowtime
+                    for j in keycolumns:
+                        times[rows, j] = rowtimes
 
-                        code = "-"
-                        for x in range(len(self._map_phenotype_to_concept)):
-                            # Check if it is an enumerated value,
-                            # then only add code
-                            if (
-                                self._map_phenotype_to_concept[x][3] == value
-                                and self._map_phenotype_to_concept[x][4]
-                                == self._data[0][j]
-                            ):  # check dbgap_code_id and varname
-                                code = self._map_phenotype_to_concept[x][
-                                    1
-                                ]  # get i2b2code
-                                value = ""
-
-                        if code == "-":
-                            # Code may have been modified or abbreviated therefore lookup correct code
-                            # do not use self._data[0][j]
-                            for x in range(
-                                len(self._map_phenotype_to_concept)
-                            ):
-                                # get string, integer, or float code with prefix if provided
-                                if (
-                                    self._map_phenotype_to_concept[x][4]
-                                    == self._data[0][j]
-                                ):  # check varname
-                                    code = self._map_phenotype_to_concept[x][
-                                        1
-                                    ]  # get i2b2code
-
-                            value = self._data[i][j]
-                        dt_string = self.fact_time(i, j)
-                        demcode = ""
-                        if "demographics_file" in self.config:
-                            demcode = self.add_demographics(
-                                code, value, prevcode
+                # Melt into facts, in row-major order
+                i, j = np.nonzero(present)
+                if len(i) == 0:
+                    continue
+                mrns = cells[i, self._patient_column]
+                times = times[i, j]
+                ids = ids[i, j]
+                values = values[i, j]
+                codetable = np.empty(len(code_ids), dtype=object)
+                codetable[:] = list(code_ids)
+                codes = codetable[ids]
+                replaced = np.zeros(len(ids), dtype=bool)
+
+                if demographics:
+                    prevcodes = np.roll(codes, 1)
+                    prevcodes[0] = self._prevcode
+                    demcodes = np.array(
+                        [
+                            (
+                                ""
+                                if code.startswith("ETHNIC")
+                                else self._demographic_codes.get(code, "")
                             )
+                            for code in codetable
+                        ],
+                        dtype=object,
+                    )[ids]
+                    ethnic = np.array(
+                        [code.startswith("ETHNIC") for code in codetable],
+                        dtype=bool,
+                    )[ids]
+                    demcodes[ethnic] = [
+                        self._ethnicity_codes.get((prevcode, code), "")
+                        for prevcode, code in zip(
+                            prevcodes[ethnic], codes[ethnic]
+                        )
+                    ]
+                    age = codes == agecode
+                    demcodes[age] = [
+                        "DEM|AGE:" + str(round(float(value)))
+                        for value in values[age]
+                    ]
+                    replaced = demcodes != ""
+                    codes = np.where(replaced, demcodes, codes)
+                    values = np.where(replaced, "", values)
+                self._prevcode = codetable[ids[-1]]
 
-                        prevcode = code
-                        if demcode != "":
-                            code = demcode
-                            value = ""
+                # Race & Ethnicity in separate columns needs a better solution
+                race = (
+                    ~replaced
+                    & np.array(
+                        [code[0:4] == "RACE" for code in codetable], dtype=bool
+                    )[ids]
+                )
+                if race.any() and (
+                    self.config["dictformat"] == "areds2"
+                    or self.config["dictformat"] == "Test"
+                ):
+                    keep = ~race
+                    mrns, times = mrns[keep], times[keep]
+                    codes, values = codes[keep], values[keep]
 
-                        if code[0:4] != "RACE" or (
-                            self.config["dictformat"] != "areds2"
-                            and self.config["dictformat"] != "Test"
-                        ):  # Race & Ethnicity in separate columns needs a better solution
-                            facts.append((mrn, str(dt_string), code, value))
+                if counters is not None:
+                    counters["facts"] += len(codes)
+                yield mrns, times, codes, values
 
-        return facts
+    # Advance past a row without generating its facts
+    def skip_row(self, row):
+        code = self.last_code(row)
+        if code is not None:
+            self._prevcode = code
 
-    def write_facts(self, factsfile, nsample=0):
-        facts = self.collect_facts()
+    #
+    # Delta mode for releases that add, change or remove rows. A row is
+    # identified by a fingerprint of its cells and, with a demographics
+    # file, of the code carried over from the previous row for race and
+    # ethnicity. Facts of rows that are not in the previous release go to
+    # deltafile, facts of rows that were removed go to retractfile.
+    #
+    # The previous release is either its input file or the row index that
+    # the previous delta run wrote to indexfile: a JSON line per row with
+    # its fingerprint and facts. A missing index counts as an empty release.
+    #
+    def write_facts_delta(
+        self, phenocsvfile, previous, indexfile, deltafile, retractfile
+    ):
+        from_index = previous.endswith(".jsonl")
+        facts_state = self.facts_state()
+        old_rows = Counter()
+        if from_index and os.path.exists(previous):
+            for row_id, facts, line in self.read_row_index(
+                previous, facts_state
+            ):
+                old_rows[row_id] += 1
+        elif not from_index:
+            for row in self.stream_rows(previous):
+                old_rows[self.row_fingerprint(row)] += 1
+                self.skip_row(row)
 
-        if nsample:
-            facts = sample(facts, int(nsample))
+        with open(indexfile + ".tmp", "w") as index:
+            index.write(json.dumps({"facts": facts_state}) + "\n")
 
-        with open(factsfile, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["mrn", "start-date", "code", "value"])
-
-            for row in facts:
-                row = list(row)
-
-                if row[2] in self._icd_vars:
-                    if row[2].startswith("ICD9"):
-                        row[2] = "dbGaP_ICD9:" + row[3]
-                        row[3] = ""
-                    elif row[2].startswith("ICD10"):
-                        row[2] = "dbGaP_ICD10:" + row[3]
-                        row[3] = ""
-                    self._used_icd_codes.append(row[2])
-                if not row[2].startswith("DEM|") and not row[2].startswith(
-                    "dbGaP"
-                ):
-                    listconcepts = list(row)
-                    listconcepts[2] = self.codeprefix + listconcepts[2]
-                    writer.writerow(listconcepts)
+            def delta_facts():
+                for row in self.stream_rows(phenocsvfile):
+                    row_id = self.row_fingerprint(row)
+                    if old_rows[row_id] > 0:
+                        old_rows[row_id] -= 1  # Unchanged row
+                        if from_index:
+                            self.skip_row(row)  # Copied from the old index
+                            continue
+                        facts = self.row_facts(row)
+                    else:
+                        facts = self.row_facts(row)
+                        yield from facts
+                    index.write(json.dumps([row_id.hex(), facts]) + "\n")
+
+            def retracted_facts():
+                if from_index:
+                    if not os.path.exists(previous):
+                        return
+                    for row_id, facts, line in self.read_row_index(
+                        previous, facts_state
+                    ):
+                        if old_rows[row_id] > 0:
+                            old_rows[row_id] -= 1
+                            yield from facts
+                        else:
+                            index.write(line)
                 else:
-                    writer.writerow(row)
+                    for row in self.stream_rows(previous):
+                        row_id = self.row_fingerprint(row)
+                        if old_rows[row_id] > 0:
+                            old_rows[row_id] -= 1
+                            yield from self.row_facts(row)
+                        else:
+                            self.skip_row(row)
 
+            nfacts = self.write_facts(deltafile, facts=delta_facts())
+            # Retracted ICD codes need no concepts
+            used_icd_codes = self._used_icd_codes
+            self._used_icd_codes = Counter()
+            nretracted = self.write_facts(retractfile, facts=retracted_facts())
+            self._used_icd_codes = used_icd_codes
+        os.replace(indexfile + ".tmp", indexfile)
+        return nfacts, nretracted
 
-#
-# Command-line arguments. Could add dictionary and input to config, but
-# there are instances where the same config will work with different inputs
-#
-def parse_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config", help="ETL config file")
-    parser.add_argument(
-        "-d", "--dictionary", help="file containing data dictionary"
-    )
-    parser.add_argument("-i", "--input", help="file data to be ETL'd")
-    parser.add_argument(
-        "-n", "--nsample", help="Number of fact records to be sampled"
-    )
-    args = parser.parse_args()
-    return args
+    def row_fingerprint(self, row):
+        digest = hashlib.blake2b(digest_size=16)
+        if "demographics_file" in self.config:
+            digest.update(self._prevcode.encode() + b"\x1e")
+        digest.update("\x1f".join(row).encode())
+        return digest.digest()
 
+    #
+    # Hash of everything besides the input row that the facts of a row
+    # depend on; a row index is only valid for the same state
+    #
+    def facts_state(self):
+        state = [
+            self.config,
+            self._map_phenotype_to_concept,
+            getattr(self, "_visit_dates", None),
+            getattr(self, "_demographic_codes", None),
+            getattr(self, "_ethnicity_codes", None),
+        ]
+        return hashlib.sha256(repr(state).encode()).hexdigest()
 
-#
-# Configuration file with parsing specifications
-#
-def load_conf(config_file):
-    try:
-        with open(config_file, "r") as f:
-            config = yaml.safe_load(f)
-    except FileNotFoundError:
-        print(f"The config file '{config_file}' does not exist.")
-        sys.exit(1)
-    except yaml.YAMLError as e:
-        print(f"Error reading the config file: {e}")
-        sys.exit(1)
+    # (fingerprint, facts, line) for the rows of a row index
+    def read_row_index(self, indexfile, facts_state):
+        with open(indexfile) as f:
+            if json.loads(f.readline())["facts"] != facts_state:
+                print(
+                    f"Error: {indexfile} was written with a different config, "
+                    "dictionary or reference files; run a full ETL instead"
+                )
+                sys.exit(1)
+            for line in f:
+                row_id, facts = json.loads(line)
+                yield bytes.fromhex(row_id), [tuple(x) for x in facts], line
 
-    return config
+    #
+    # Facts for the rows between the byte offsets start and end, which must
+    # be row boundaries. prevcode is the code of the last cell before the
+    # chunk, so that race/ethnicity lookups see the same previous code as
+    # in a serial run.
+    #
+    def chunk_facts(self, phenocsvfile, start, end, prevcode=""):
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        with PhenotypeFile(
+            phenocsvfile, encoding, delimiter, start, end
+        ) as data:
+            self.read_header(data.header)
+            self._prevcode = prevcode
+            for row in data.rows():
+                yield from self.row_facts(row)
 
+    # Code of the last cell of a row that row_facts turns into a fact
+    def last_code(self, row):
+        for j in reversed(range(len(row))):
+            if j in self._skip_columns or row[j].strip() == "":
+                continue
+            code = self._concept_index.get((self._header[j], row[j]))
+            if code is None:
+                code = self._default_codes.get(self._header[j], "-")
+            return code
+        return None
 
-def main():
-    inputs = parse_args()
-    etl_conf = load_conf(inputs.config)
-    etl = ETLdbGap(etl_conf)
-    etl.read_data_dictionary(inputs.dictionary)
-    etl.read_visit_dates_file()
-    etl.read_demographics_file()
-    conceptsfile = etl_conf["filebase"] + "_concepts.csv"
-    etl.write_concepts(conceptsfile)
-    etl.read_facts(inputs.input)
-    factsfile = etl_conf["filebase"] + "_facts.csv"
-    etl.write_facts(factsfile, inputs.nsample)
-    if etl.icd_codes():
-        if etl.read_icd_codes("i2b2_icd_codes.csv"):
-            conceptsfile = etl_conf["filebase"] + "_icd_concepts.csv"
-            etl.write_icd_concepts(conceptsfile)
+    #
+    # Run chunk_facts for row ranges of the input, workers * 4 ranges of
+    # about the same number of rows, in a process pool and concatenate the
+    # shard outputs in input order, which matches the output of a serial
+    # run.
+    #
+    def write_facts_parallel(self, factsfile, phenocsvfile, workers):
+        encoding, delimiter = self.facts_format(phenocsvfile)
+        with PhenotypeFile(phenocsvfile, encoding, delimiter) as data:
+            nrows = len(data)
+            step = max(1, -(-nrows // (workers * 4)))
+            # A copy reads the header, so that self stays picklable
+            scan = copy.copy(self)
+            scan.read_header(data.header)
+            chunks = [
+                (
+                    data.offsets[k],
+                    data.offsets[min(k + step, nrows)],
+                    scan.previous_code(data, k),
+                )
+                for k in range(0, nrows, step)
+            ]
+        shard_dir = tempfile.mkdtemp(
+            prefix=".shards-", dir=os.path.dirname(factsfile) or "."
+        )
+        try:
+            tasks = [
+                (
+                    phenocsvfile,
+                    start,
+                    end,
+                    prevcode,
+                    os.path.join(shard_dir, str(k) + ".csv"),
+                )
+                for k, (start, end, prevcode) in enumerate(chunks)
+            ]
+            with ProcessPoolExecutor(
+                workers, initializer=init_worker, initargs=(self,)
+            ) as pool:
+                results = list(
+                    self.track(pool.map(write_shard, tasks), len(tasks))
+                )
+
+            with open_file(factsfile, "wb") as f:
+                f.write(b"mrn,start-date,code,value\r\n")
+                for task in tasks:
+                    with open(task[-1], "rb") as shard:
+                        shard.readline()  # Header
+                        shutil.copyfileobj(shard, f)
+        finally:
+            shutil.rmtree(shard_dir)
+
+        nfacts = 0
+        for used_icd_codes, count, counters in results:
+            self._used_icd_codes.update(used_icd_codes)
+            nfacts += count
+            if self.stats is not None:
+                self.stats.counters.update(counters)
+        return nfacts
+
+    # Code of the last cell before row k, recovered from the preceding rows
+    def previous_code(self, data, k):
+        for row in data.rows_before(k):
+            code = self.last_code(row)
+            if code is not None:
+                return code
+        return ""
+
+    # Code of a fact in the facts file: i2b2 demographic and ICD codes are
+    # written as they are, other codes get the codeprefix
+    def output_code(self, code):
+        if code.startswith("DEM|") or code.startswith("dbGaP"):
+            return code
+        return self.codeprefix + code
+
+    def row_facts(self, row):
+        facts = []
+        row_times = {}  # timestamps computed for this row
+        # Patient ID
+        mrn = row[self._patient_column]
+
+        # Loop through the cells of the fact columns in row
+        ncells = len(row)
+        for j in self._fact_columns:
+            if j >= ncells:
+                break
+            value = row[j]
+            if value.strip() == "":
+                continue
+            varname = self._header[j]
+
+            # Check if it is an enumerated value (dbgap_code_id and
+            # varname), then only add code
+            code = self._concept_index.get((varname, value))
+            if code is not None:
+                value = ""
+            else:
+                # Code may have been modified or abbreviated therefore lookup correct code
+                # get string, integer, or float code with prefix if provided
+                code = self._default_codes.get(varname, "-")
+            timekey = self._column_times[j]
+            try:
+                dt_string = row_times[timekey]
+            except KeyError:
+                dt_string = str(self._time_resolvers[timekey](row))
+                row_times[timekey] = dt_string
+            demcode = ""
+            if "demographics_file" in self.config:
+                demcode = self.add_demographics(code, value, self._prevcode)
+
+            self._prevcode = code
+            if demcode != "":
+                code = demcode
+                value = ""
+
+            if code[0:4] != "RACE" or (
+                self.config["dictformat"] != "areds2"
+                and self.config["dictformat"] != "Test"
+            ):  # Race & Ethnicity in separate columns needs a better solution
+                facts.append((mrn, dt_string, code, value))
+        if self.stats is not None:
+            self.count_row(row, facts)
+        return facts
+
+    #
+    # Counters of a row for --stats. Skipped cells are empty or hold the
+    # patient ID or a time variable; lookup misses are values of encoded
+    # variables that are none of their codes.
+    #
+    def count_row(self, row, facts):
+        counters = self.stats.counters
+        counters["rows"] += 1
+        counters["cells"] += len(row)
+        counters["facts"] += len(facts)
+        for j, value in enumerate(row):
+            if j in self._skip_columns or value.strip() == "":
+                counters["cells_skipped"] += 1
+                continue
+            varname = self._header[j]
+            if varname not in self._default_codes:
+                counters["unknown_variables"] += 1
+            elif (
+                varname in self._enumerated_vars
+                and (varname, value) not in self._concept_index
+            ):
+                counters["lookup_misses"] += 1
+
+    def write_facts(
+        self,
+        factsfile,
+        nsample=0,
+        facts=None,
+        seed=None,
+        nsubjects=0,
+        pipeline=False,
+        sort=False,
+        partitions=0,
+        dedup=None,
+    ):
+        facts = self.select_facts(nsample, facts, seed, nsubjects)
+        tmpdir = os.path.dirname(factsfile) or "."
+        batches = self.fact_batches(facts, pipeline, sort, tmpdir, dedup)
+        if partitions:
+            return write_partitions(factsfile, partitions, batches)
+        nfacts = 0
+        with open_file(factsfile, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(FACT_COLUMNS)
+            for batch in batches:
+                writer.writerows(batch)
+                nfacts += len(batch)
+        return nfacts
+
+    # write_facts for --format parquet and arrow
+    def write_facts_table(
+        self,
+        factsfile,
+        format,
+        nsample=0,
+        facts=None,
+        seed=None,
+        nsubjects=0,
+        pipeline=False,
+        sort=False,
+        dedup=None,
+    ):
+        facts = self.select_facts(nsample, facts, seed, nsubjects)
+        tmpdir = os.path.dirname(factsfile) or "."
+        batches = self.fact_batches(facts, pipeline, sort, tmpdir, dedup)
+        nfacts = 0
+        with TableWriter(factsfile, format, FACT_COLUMNS) as writer:
+            group = []
+            for batch in batches:
+                group += batch
+                if len(group) >= ROW_GROUP_SIZE:
+                    writer.write(group)
+                    nfacts += len(group)
+                    group = []
+            if group or not nfacts:
+                writer.write(group)
+                nfacts += len(group)
+        return nfacts
+
+    # The facts to output: all facts of the input, or a sample
+    def select_facts(self, nsample=0, facts=None, seed=None, nsubjects=0):
+        if facts is None:
+            facts = self.collect_facts()
+
+        rng = Random(seed)
+        if nsubjects:
+            facts = sample_subjects(facts, int(nsubjects), rng)
+        if nsample:
+            facts = sample_facts(facts, int(nsample), rng)
+        return facts
+
+    #
+    # output_batches, with dedup ("memory" or "disk") without duplicate
+    # facts, with pipeline computed in a thread while the caller writes the
+    # batches before, with sort ordered by sorted_batches; temporary files
+    # go to tmpdir
+    #
+    def fact_batches(
+        self, facts, pipeline=False, sort=False, tmpdir=".", dedup=None
+    ):
+        batches = self.output_batches(facts)
+        if dedup:
+            batches = self.dedup_batches(batches, dedup == "disk", tmpdir)
+        if pipeline:
+            batches = pipelined(batches)
+        if sort:
+            batches = sorted_batches(batches, tmpdir)
+        return batches
+
+    #
+    # write_facts for the columnar engine: blocks of facts are output and
+    # formatted with array operations, without a tuple per fact
+    #
+    def write_columnar_facts(self, factsfile, phenocsvfile):
+        nfacts = 0
+        with open_file(factsfile, "w", newline="") as f:
+            csv.writer(f).writerow(FACT_COLUMNS)
+            for block in self.columnar_blocks(phenocsvfile):
+                mrns, times, codes, values = self.output_block(*block)
+                f.write(csv_lines([mrns, times, codes, values]))
+                nfacts += len(codes)
+        return nfacts
+
+    #
+    # output_batches for a block of facts as arrays: the output of each
+    # distinct code is computed once, and the ICD codes of the block are
+    # rewritten at once
+    #
+    def output_block(self, mrns, times, codes, values):
+        icd_vars = set(self._icd_vars)
+        labels, uniques = pd.factorize(codes)
+        outputs = np.empty(len(uniques), dtype=object)
+        outputs[:] = [self.output_code(code) for code in uniques]
+        icd = np.array([code in icd_vars for code in uniques], dtype=bool)
+        prefixes = np.array(
+            [
+                (
+                    "dbGaP_ICD9:"
+                    if code.startswith("ICD9")
+                    else "dbGaP_ICD10:" if code.startswith("ICD10") else ""
+                )
+                for code in uniques
+            ],
+            dtype=object,
+        )
+        codes = outputs[labels]
+        counted = icd[labels]
+        if counted.any():
+            used = uniques[labels[counted]].astype(object)
+            rewritten = prefixes[labels] != ""
+            rewritten &= counted
+            used[rewritten[counted]] = (
+                prefixes[labels[rewritten]] + values[rewritten]
+            )
+            codes[rewritten] = used[rewritten[counted]]
+            values = values.copy()
+            values[rewritten] = ""
+            self._used_icd_codes.update(used.tolist())
+        if self.stats is not None:
+            self.stats.counters["facts_written"] += len(codes)
+        return mrns, times, codes, values
+
+    #
+    # Batches without the facts that are identical to an earlier fact, which
+    # are counted in duplicate_facts. With spill the fingerprints of the
+    # facts seen are kept on disk in tmpdir.
+    #
+    def dedup_batches(self, batches, spill=False, tmpdir="."):
+        fingerprints = FingerprintSet(spill, tmpdir)
+        try:
+            for batch in batches:
+                new = fingerprints.add_new(batch)
+                duplicates = len(batch) - len(new)
+                self.duplicate_facts += duplicates
+                if self.stats is not None:
+                    self.stats.counters["duplicate_facts"] += duplicates
+                    self.stats.counters["facts_written"] -= duplicates
+                yield new
+        finally:
+            fingerprints.close()
+
+    #
+    # Facts as output, in lists of up to WRITE_BATCH facts: ICD codes are
+    # rewritten to i2b2 ICD codes and recorded as used, and other codes get
+    # the codeprefix
+    #
+    def output_batches(self, facts):
+        icd_vars = set(self._icd_vars)
+        output_codes = {}  # code -> code written to the facts file
+        batch = []
+        for mrn, start_date, code, value in facts:
+            if code in icd_vars:
+                if code.startswith("ICD9"):
+                    code = "dbGaP_ICD9:" + value
+                    value = ""
+                elif code.startswith("ICD10"):
+                    code = "dbGaP_ICD10:" + value
+                    value = ""
+                self._used_icd_codes[code] += 1
+                output_code = self.output_code(code)
+            else:
+                output_code = output_codes.get(code)
+                if output_code is None:
+                    output_code = output_codes[code] = self.output_code(code)
+            batch.append((mrn, start_date, output_code, value))
+            if len(batch) == WRITE_BATCH:
+                if self.stats is not None:
+                    self.stats.counters["facts_written"] += len(batch)
+                yield batch
+                batch = []
+        if self.stats is not None:
+            self.stats.counters["facts_written"] += len(batch)
+        yield batch
+
+
+#
+# Open a file that is gzip, bzip2 or zstd compressed when its name ends
+# with .gz, .bz2 or .zst, else a plain file. Text modes take the arguments
+# of open. Compressed files opened for reading are decompressed in a
+# thread, ahead of the reader; the codecs release the interpreter lock
+# while they decompress, so decompression and parsing run in parallel.
+#
+def open_file(path, mode="r", **kwargs):
+    if "b" not in mode and "t" not in mode:
+        mode += "t"  # Compressed files open in binary mode by default
+    if not is_compressed(path):
+        return open(path, mode, **kwargs)
+    if "r" not in mode:
+        return open_compressed(path, mode, **kwargs)
+    chunks = pipelined(read_chunks(open_compressed(path, "rb")))
+    f = io.BufferedReader(ChunkReader(chunks))
+    if "t" in mode:
+        return io.TextIOWrapper(f, **kwargs)
+    return f
+
+
+def open_compressed(path, mode, **kwargs):
+    if path.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        return gzip.open(path, mode, compresslevel=6, **kwargs)
+    elif path.endswith(COMPRESSION_SUFFIXES["bzip2"]):
+        return bz2.open(path, mode, **kwargs)
+    else:
+        if zstandard is None:
+            print("Error: .zst files require the zstandard package")
+            sys.exit(1)
+        return zstandard.open(path, mode, **kwargs)
+
+
+def is_compressed(path):
+    return path.endswith(tuple(COMPRESSION_SUFFIXES.values()))
+
+
+#
+# Name of a file without its compression suffix; the encoding and the
+# delimiter of an input go by the extension of the uncompressed file, e.g.
+# .txt for phenotype.txt.gz
+#
+def uncompressed_name(path):
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+# Chunks of DECOMPRESS_CHUNK bytes of a binary file, which is then closed
+def read_chunks(f):
+    with f:
+        while True:
+            chunk = f.read(DECOMPRESS_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+
+# Raw binary stream of an iterator of byte chunks
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0  # End of file
+            self._chunk = memoryview(chunk)
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._chunks.close()
+        super().close()
+
+
+#
+# Writer of a table in Parquet or Arrow IPC file format. The mrn and code
+# columns are dictionary-encoded and start-date is a date32 column (null
+# for dates that are not YYYY-MM-DD). Every write is a Parquet row group or
+# an Arrow record batch. A Parquet row group has dictionaries of its own
+# values; an Arrow file has one dictionary per column that grows batch by
+# batch, written as dictionary deltas. Arrow files are uncompressed so that
+# readers can memory-map them without copying; Parquet files are zstd
+# compressed.
+#
+class TableWriter:
+    DICTIONARY_COLUMNS = ("mrn", "code")
+
+    def __init__(self, path, format, columns):
+        import_pyarrow(f"--format {format}")
+        fields = []
+        for name in columns:
+            if name in self.DICTIONARY_COLUMNS:
+                fields.append((name, pa.dictionary(pa.int32(), pa.string())))
+            elif name == "start-date":
+                fields.append((name, pa.date32()))
+            else:
+                fields.append((name, pa.string()))
+        self.schema = pa.schema(fields)
+        self.format = format
+        # Arrow dictionaries: value -> index, and the values as an array
+        self._ids = {name: {} for name in self.DICTIONARY_COLUMNS}
+        self._dictionaries = {
+            name: pa.array([], pa.string()) for name in self.DICTIONARY_COLUMNS
+        }
+        if format == "parquet":
+            self._writer = pq.ParquetWriter(
+                path, self.schema, compression="zstd"
+            )
+        else:
+            self._writer = pa.ipc.new_file(
+                path,
+                self.schema,
+                options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._writer.close()
+
+    def write(self, rows):
+        items = list(zip(*rows)) or [()] * len(self.schema)
+        columns = []
+        for field, values in zip(self.schema, items):
+            if field.name in self._ids and self.format == "parquet":
+                columns.append(
+                    pa.array(values, pa.string()).dictionary_encode()
+                )
+            elif field.name in self._ids:
+                ids = self._ids[field.name]
+                known = len(ids)
+                indices = map(ids.setdefault, values, map(len, repeat(ids)))
+                indices = pa.array(list(indices), pa.int32())
+                # The dictionary so far and the values new in this batch
+                dictionary = pa.concat_arrays(
+                    [
+                        self._dictionaries[field.name],
+                        pa.array(
+                            list(islice(ids, known, None)),
+                            pa.string(),
+                        ),
+                    ]
+                )
+                self._dictionaries[field.name] = dictionary
+                columns.append(
+                    pa.DictionaryArray.from_arrays(indices, dictionary)
+                )
+            elif field.type == pa.date32():
+                dates = pc.strptime(
+                    pa.array(values, pa.string()),
+                    format="%Y-%m-%d",
+                    unit="s",
+                    error_is_null=True,
+                )
+                columns.append(pc.cast(dates, pa.date32()))
+            else:
+                columns.append(pa.array(values, pa.string()))
+        self._writer.write_batch(pa.record_batch(columns, schema=self.schema))
+
+
+def write_table(path, format, columns, rows):
+    with TableWriter(path, format, columns) as writer:
+        writer.write(rows)
+
+
+#
+# Import NumPy and pandas on first use rather than with etl.py, as they
+# take long to import and only the columnar engine needs them
+#
+def import_pandas():
+    global np, pd
+    try:
+        import numpy as np
+        import pandas as pd
+    except ImportError:
+        print("Error: the columnar engine requires pandas")
+        sys.exit(1)
+
+
+#
+# CSV lines of columns, arrays of strings, as csv.writer writes them: a
+# cell is quoted if it contains a comma, a quote or a line break. Cells
+# are checked and quoted once per distinct value.
+#
+def csv_lines(columns):
+    line = np.empty((len(columns[0]), 2 * len(columns)), dtype=object)
+    for k, column in enumerate(columns):
+        labels, uniques = pd.factorize(column)
+        if NEEDS_QUOTES.search("\0".join(uniques.tolist())):
+            uniques = np.array(
+                [
+                    (
+                        '"' + cell.replace('"', '""') + '"'
+                        if NEEDS_QUOTES.search(cell)
+                        else cell
+                    )
+                    for cell in uniques
+                ],
+                dtype=object,
+            )
+            column = uniques[labels]
+        line[:, 2 * k] = column
+        line[:, 2 * k + 1] = ","
+    line[:, -1] = "\r\n"
+    return "".join(line.ravel().tolist())
+
+
+#
+# Import pyarrow on first use rather than with etl.py, as it takes long to
+# import and only Parquet and Arrow files need it
+#
+def import_pyarrow(use):
+    global pa, pc, pq
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        print(f"Error: {use} requires the pyarrow package")
+        sys.exit(1)
+
+
+# The values of a column of a Parquet or Arrow file written by TableWriter
+def read_table(path, column):
+    import_pyarrow("reading Parquet and Arrow files")
+    if path.endswith(OUTPUT_SUFFIXES["parquet"]):
+        table = pq.read_table(path, columns=[column])
+    else:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    return table[column].to_pylist()
+
+
+#
+# Iterate over items in a thread that runs up to depth items ahead of the
+# caller; a bounded queue holds the items in between, so the thread waits
+# while the caller is behind. An exception raised by the iteration is
+# raised in the caller. When the caller stops early, the thread stops and
+# closes items.
+#
+def pipelined(items, depth=PIPELINE_DEPTH):
+    buffer = queue.Queue(depth)
+    stop = threading.Event()
+    end = object()  # Marks the end of items
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as e:  # Includes the SystemExit of errors
+            put((end, e))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+#
+# Set of the facts seen by --dedup, as 16-byte BLAKE2b fingerprints of the
+# facts, held in memory. With spill, whenever DEDUP_MEMORY fingerprints are
+# in memory they are moved to an SQLite table in a temporary directory in
+# tmpdir, so that memory use stays bounded for inputs with more distinct
+# facts than fit in memory.
+#
+class FingerprintSet:
+    QUERY_SIZE = 500  # Fingerprints looked up per SQLite query
+
+    def __init__(self, spill=False, tmpdir="."):
+        self._seen = set()
+        self._spill = spill
+        self._tmpdir = tmpdir
+        self._db = None
+
+    # The facts of batch that were not seen before, in order; they are added
+    def add_new(self, batch):
+        seen = self._seen
+        facts = {}  # fingerprint -> first fact in batch not seen
+        for fact in batch:
+            fingerprint = fact_fingerprint(fact)
+            if fingerprint not in seen:
+                facts.setdefault(fingerprint, fact)
+        if self._db is not None:
+            fingerprints = list(facts)
+            query = "SELECT fingerprint FROM seen WHERE fingerprint IN (%s)"
+            for k in range(0, len(fingerprints), self.QUERY_SIZE):
+                chunk = fingerprints[k : k + self.QUERY_SIZE]
+                for (fingerprint,) in self._db.execute(
+                    query % ",".join("?" * len(chunk)), chunk
+                ):
+                    del facts[fingerprint]
+        seen.update(facts)
+        if self._spill and len(seen) >= DEDUP_MEMORY:
+            self.spill()
+        return list(facts.values())
+
+    # Move the fingerprints in memory to the SQLite table
+    def spill(self):
+        if self._db is None:
+            self._dir = tempfile.TemporaryDirectory(
+                prefix=".dedup-", dir=self._tmpdir
+            )
+            self._db = sqlite3.connect(
+                os.path.join(self._dir.name, "fingerprints.db")
+            )
+            self._db.execute("PRAGMA journal_mode = OFF")
+            self._db.execute("PRAGMA synchronous = OFF")
+            self._db.execute(
+                "CREATE TABLE seen (fingerprint BLOB PRIMARY KEY) WITHOUT ROWID"
+            )
+        self._db.executemany(
+            "INSERT INTO seen VALUES (?)",
+            ((fingerprint,) for fingerprint in sorted(self._seen)),
+        )
+        self._seen.clear()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._dir.cleanup()
+
+
+def fact_fingerprint(fact):
+    return hashlib.blake2b("\x1f".join(fact).encode(), digest_size=16).digest()
+
+
+#
+# External merge sort of batches of facts by (mrn, start-date, code), as
+# strings. Runs of up to runsize facts are sorted in memory and spilled to
+# a temporary directory in tmpdir, then merged fanin runs at a time, so
+# memory use is bounded by the run size. Facts with the same key keep
+# their order. Yields the sorted facts in batches of WRITE_BATCH facts.
+#
+def sorted_batches(batches, tmpdir, runsize=SORT_RUN_SIZE, fanin=SORT_FANIN):
+    key = itemgetter(0, 1, 2)
+    with tempfile.TemporaryDirectory(prefix=".sort-", dir=tmpdir) as rundir:
+        runs = []
+        run = []
+        for batch in batches:
+            run += batch
+            if len(run) >= runsize:
+                run.sort(key=key)
+                runs.append(write_run(batched(run), rundir))
+                run = []
+        run.sort(key=key)
+        if not runs:
+            yield from batched(run)
+            return
+        if run:
+            runs.append(write_run(batched(run), rundir))
+        while len(runs) > fanin:
+            runs = [
+                write_run(merge_runs(runs[k : k + fanin], key), rundir)
+                for k in range(0, len(runs), fanin)
+            ]
+        yield from merge_runs(runs, key)
+
+
+# Lists of up to size items of a list or iterator
+def batched(items, size=WRITE_BATCH):
+    if isinstance(items, list):
+        for k in range(0, len(items), size):
+            yield items[k : k + size]
+        return
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Write batches to a new run file in rundir and return its path
+def write_run(batches, rundir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=rundir)
+    with os.fdopen(fd, "wb") as f:
+        for batch in batches:
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+# Facts of a run file, which is removed once read
+def read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                break
+    os.remove(path)
+
+
+# Batches of the merged facts of sorted run files
+def merge_runs(paths, key):
+    return batched(heapq.merge(*map(read_run, paths), key=key))
+
+
+# Facts file of partition k of --partitions: <filebase>_facts.part-K.csv
+def partition_file(factsfile, k):
+    base, suffix, compression = factsfile.rpartition(OUTPUT_SUFFIXES["csv"])
+    return f"{base}.part-{k}{suffix}{compression}"
+
+
+#
+# Write batches of facts to npartitions facts files; the partition of a
+# fact is a hash of its mrn, so all facts of a subject are in the same
+# file, in the order of the batches. Returns the number of facts written.
+#
+def write_partitions(factsfile, npartitions, batches):
+    nfacts = 0
+    with contextlib.ExitStack() as files:
+        writers = []
+        for k in range(npartitions):
+            f = files.enter_context(
+                open_file(partition_file(factsfile, k), "w", newline="")
+            )
+            writers.append(csv.writer(f))
+            writers[-1].writerow(FACT_COLUMNS)
+        partition_of = {}  # mrn -> partition
+        for batch in batches:
+            parts = [[] for writer in writers]
+            for fact in batch:
+                k = partition_of.get(fact[0])
+                if k is None:
+                    k = zlib.crc32(fact[0].encode()) % npartitions
+                    partition_of[fact[0]] = k
+                parts[k].append(fact)
+            for writer, part in zip(writers, parts):
+                writer.writerows(part)
+            nfacts += len(batch)
+    return nfacts
+
+
+#
+# Single-pass reservoir sampling (Algorithm R) over a fact stream. The
+# sampled facts are returned in stream order.
+#
+def sample_facts(facts, nsample, rng):
+    reservoir = []
+    for k, fact in enumerate(facts):
+        if k < nsample:
+            reservoir.append((k, fact))
+        else:
+            r = rng.randrange(k + 1)
+            if r < nsample:
+                reservoir[r] = (k, fact)
+    reservoir.sort(key=lambda item: item[0])
+    return [fact for k, fact in reservoir]
+
+
+#
+# Reservoir sampling of subjects: all facts of nsubjects random patients.
+# A subject is accepted or rejected when its first fact is seen; the facts
+# of a subject that is later evicted from the reservoir are dropped.
+#
+def sample_subjects(facts, nsubjects, rng):
+    reservoir = []  # sampled mrns
+    selected = {}  # mrn -> [(position, fact)]
+    seen = set()
+    for k, fact in enumerate(facts):
+        mrn = fact[0]
+        if mrn not in seen:
+            seen.add(mrn)
+            if len(reservoir) < nsubjects:
+                reservoir.append(mrn)
+                selected[mrn] = []
+            else:
+                r = rng.randrange(len(seen))
+                if r < nsubjects:
+                    del selected[reservoir[r]]
+                    reservoir[r] = mrn
+                    selected[mrn] = []
+        if mrn in selected:
+            selected[mrn].append((k, fact))
+    sampled = [item for items in selected.values() for item in items]
+    sampled.sort(key=lambda item: item[0])
+    return [fact for k, fact in sampled]
+
+
+#
+# Phenotype file read through a memory map. The rows are indexed by their
+# byte offsets in one pass, so any range of rows can be read without
+# reading the rows before it, and rows are decoded a block at a time as
+# they are used instead of all up front. With start and end, only the rows
+# between these byte offsets, which must be row boundaries, are indexed.
+# Quoted cells may contain line breaks.
+#
+class PhenotypeFile:
+    def __init__(self, path, encoding, delimiter, start=None, end=None):
+        self.encoding = encoding
+        self.delimiter = delimiter
+        if is_compressed(path):
+            # Compressed files are decompressed into memory instead
+            with open_file(path, "rb") as f:
+                self._map = f.read()
+            size = len(self._map)
+        else:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self._map = b""  # Empty files cannot be mapped
+                if size:
+                    self._map = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+        self._row = row_pattern(delimiter.encode())
+        self.header_end = next(self.row_ends(0, size), size)
+        self.header = parse_line(self._map[: self.header_end], *self.format)
+        if start is None:
+            start, end = self.header_end, size
+        # Row k spans the bytes from offsets[k] to offsets[k + 1]
+        self.offsets = array("Q", [start])
+        self.offsets.extend(self.row_ends(start, end))
+        if self.offsets[-1] < end:
+            self.offsets.append(end)
+
+    @property
+    def format(self):
+        return self.encoding, self.delimiter
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    # Rows start to stop - 1, decoded in blocks of about blocksize bytes
+    def rows(self, start=0, stop=None, blocksize=1 << 20):
+        for block in self.blocks(start, stop, blocksize):
+            yield from block
+
+    # Lists of the rows of blocks of about blocksize bytes
+    def blocks(self, start=0, stop=None, blocksize=1 << 20):
+        offsets = self.offsets
+        stop = len(self) if stop is None else min(stop, len(self))
+        while start < stop:
+            end = bisect(offsets, offsets[start] + blocksize) - 1
+            end = min(max(end, start + 1), stop)
+            block = self._map[offsets[start] : offsets[end]]
+            yield list(
+                csv.reader(
+                    io.StringIO(block.decode(self.encoding), newline=None),
+                    delimiter=self.delimiter,
+                )
+            )
+            start = end
+
+    #
+    # Byte offsets of the row ends between start and end. Line breaks only
+    # end a row outside quoted cells; a file without quotes is split at
+    # every line break, which is faster.
+    #
+    def row_ends(self, start, end):
+        if self._map.find(b'"', start, end) == -1:
+            for m in LINE_END.finditer(self._map, start, end):
+                yield m.end()
+            return
+        pos = start
+        for m in self._row.finditer(self._map, start, end):
+            if m.start() != pos:
+                break  # A quote that is never closed: the rest is one row
+            pos = m.end()
+            yield pos
+
+    # Rows before row k, last row first
+    def rows_before(self, k):
+        offsets = self.offsets
+        for j in reversed(range(k)):
+            row = self._map[offsets[j] : offsets[j + 1]]
+            yield parse_line(row, *self.format)
+
+
+#
+# Pattern of a row as csv.reader splits it: a cell is quoted if it starts
+# with a quote, and "" is a quote inside a quoted cell. Other quotes are
+# part of the cell.
+#
+def row_pattern(delimiter):
+    d = re.escape(delimiter)
+    cell = b'(?:"[^"]*(?:""[^"]*)*"[^%s\n]*|(?!")[^%s\n]*)' % (d, d)
+    return re.compile(b"%s(?:%s%s)*\n" % (cell, d, cell))
+
+
+def parse_line(line, encoding, delimiter):
+    text = io.StringIO(line.decode(encoding), newline=None)
+    return next(csv.reader(text, delimiter=delimiter), [])
+
+
+# Process pool workers for ETLdbGap.write_facts_parallel
+_worker_etl = None
+
+
+def init_worker(etl):
+    global _worker_etl
+    _worker_etl = etl
+
+
+def write_shard(task):
+    phenocsvfile, start, end, prevcode, shardfile = task
+    _worker_etl._used_icd_codes = Counter()
+    if _worker_etl.stats is not None:
+        # Counters of the shard; the parent reports progress
+        _worker_etl.stats = RunStats(_worker_etl.stats.name, interval=None)
+    nfacts = _worker_etl.write_facts(
+        shardfile,
+        facts=_worker_etl.chunk_facts(phenocsvfile, start, end, prevcode),
+    )
+    counters = Counter()
+    if _worker_etl.stats is not None:
+        counters = _worker_etl.stats.counters
+    return _worker_etl._used_icd_codes, nfacts, counters
+
+
+# concept_state of a data dictionary for the config keys of key, a JSON
+# list of [name, value] pairs
+def parse_concepts(dictfile, key):
+    etl = ETLdbGap(dict(json.loads(key)))
+    etl.read_data_dictionary(dictfile)
+    etl.map_concepts()
+    return etl.concept_state()
+
+
+# Process pool workers for run_batch and serve
+_worker_references = None
+
+
+def init_batch_worker(references):
+    global _worker_references
+    _worker_references = references
+
+
+def run_job(etl_conf, inputs):
+    start = time.perf_counter()
+    nfacts = run_etl(etl_conf, inputs, _worker_references)
+    return nfacts, time.perf_counter() - start
+
+
+# Run a job of serve: its result with --stats and its output
+def serve_job(etl_conf, inputs):
+    stats = RunStats(etl_conf["filebase"], interval=None)
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            nfacts = run_etl(etl_conf, inputs, _worker_references, stats)
+    except BaseException as e:  # Includes the SystemExit of errors
+        return {"error": repr(e), "output": output.getvalue()}
+    return {
+        "facts": nfacts,
+        "seconds": time.perf_counter() - start,
+        "stages": stats.stages,
+        "counters": stats.counters,
+        "reloads": _worker_references.reloads,
+        "output": output.getvalue(),
+    }
+
+
+#
+# Command-line arguments. Could add dictionary and input to config, but
+# there are instances where the same config will work with different inputs
+#
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="ETL config file")
+    parser.add_argument(
+        "-d", "--dictionary", help="file containing data dictionary"
+    )
+    parser.add_argument("-i", "--input", help="file data to be ETL'd")
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="manifest of config, input and dictionary files to be ETL'd",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of batch or --serve jobs run concurrently",
+    )
+    parser.add_argument(
+        "-n", "--nsample", help="Number of fact records to be sampled"
+    )
+    parser.add_argument(
+        "--nsubjects",
+        help="Number of subjects whose facts are all sampled",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="Random seed for reproducible sampling"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes generating facts for chunks of the input",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only rebuild outputs whose inputs changed since the last run",
+    )
+    parser.add_argument(
+        "--delta-from",
+        help="previous input file or <filebase>_rows.jsonl row index; only "
+        "facts of new and removed rows are written",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["rows", "columnar"],
+        default="rows",
+        help="fact generation engine; columnar uses pandas on blocks of rows",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the input and write facts row by row in bounded memory",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="read the input, generate facts and write them at the same "
+        "time in threads",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="order the facts by mrn, start-date and code with a "
+        "bounded-memory external sort",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=0,
+        help="split the facts by subject into N files "
+        "<filebase>_facts.part-K.csv",
+    )
+    parser.add_argument(
+        "--dedup",
+        nargs="?",
+        const="memory",
+        choices=["memory", "disk"],
+        help="drop facts identical to an earlier fact; 'disk' keeps the "
+        "fingerprints of the facts in a temporary SQLite file",
+    )
+    parser.add_argument(
+        "--db",
+        help="load facts and concepts into this database instead of CSV "
+        "files: sqlite:///path or postgresql://user@host/dbname",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=sorted(COMPRESSION_SUFFIXES),
+        help="compress the facts files, e.g. <filebase>_facts.csv.gz",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(OUTPUT_SUFFIXES),
+        default="csv",
+        help="format of the facts and concepts files; parquet and arrow "
+        "need pyarrow",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="hold facts in memory dictionary-encoded; less memory, slower",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory caching parsed data dictionaries and their concepts",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="report progress, stage timings and row, cell and fact counts",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile the run with cProfile into <filebase>_profile.prof",
+    )
+    parser.add_argument(
+        "--serve",
+        help="run as a daemon serving ETL jobs over HTTP on a Unix socket "
+        "path or host:port, with -j worker processes",
+    )
+    args = parser.parse_args(argv)
+    return args
+
+
+#
+# Compiled regular expressions of the include_vars or exclude_vars key of
+# a config: a pattern or a list of patterns that variable names must match
+# in full
+#
+def var_patterns(config, key):
+    patterns = config.get(key) or []
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    try:
+        return [re.compile(str(pattern)) for pattern in patterns]
+    except re.error as e:
+        print(f"Error: invalid {key} pattern: {e}")
+        sys.exit(1)
+
+
+#
+# Configuration file with parsing specifications
+#
+def load_conf(config_file):
+    try:
+        with open(config_file, "r") as f:
+            config = yaml.safe_load(f)
+    except FileNotFoundError:
+        print(f"The config file '{config_file}' does not exist.")
+        sys.exit(1)
+    except yaml.YAMLError as e:
+        print(f"Error reading the config file: {e}")
+        sys.exit(1)
+
+    return config
+
+
+#
+# Build cache for incremental runs. For every output file, <filebase>_build.json
+# records the content hashes of the files and settings it was built from;
+# an output whose inputs are unchanged is not rebuilt.
+#
+class BuildCache:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self._outputs = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._outputs = {}
+
+    # The cache entry of an output that is up to date, else None
+    def current(self, output, inputs):
+        entry = self._outputs.get(output)
+        if inputs is None or entry is None or entry["inputs"] != inputs:
+            return None
+        try:
+            stat = os.stat(output)
+        except FileNotFoundError:
+            return None
+        if [stat.st_size, stat.st_mtime_ns] != entry["stat"]:
+            return None  # Changed since it was built
+        return entry
+
+    def record(self, output, inputs, **info):
+        if inputs is None:
+            return
+        stat = os.stat(output)
+        self._outputs[output] = dict(
+            info, inputs=inputs, stat=[stat.st_size, stat.st_mtime_ns]
+        )
+        with open(self.path, "w") as f:
+            json.dump(self._outputs, f, indent=1, sort_keys=True)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#
+# Inputs of the concepts and facts files for the build cache. The facts
+# of an unseeded sample differ on every run and are never up to date.
+#
+def build_inputs(etl_conf, inputs):
+    config = json.dumps(etl_conf, sort_keys=True, default=str)
+    concept_inputs = {
+        "config": hashlib.sha256(config.encode()).hexdigest(),
+        "dictionary": file_hash(inputs.dictionary),
+    }
+    if "demographics_file" in etl_conf:
+        concept_inputs["demographics_file"] = file_hash(
+            etl_conf["demographics_file"]
+        )
+    if (inputs.nsample or inputs.nsubjects) and inputs.seed is None:
+        return concept_inputs, None
+    fact_inputs = dict(
+        concept_inputs,
+        input=file_hash(inputs.input),
+        sample=[inputs.nsample, inputs.nsubjects, inputs.seed],
+    )
+    if inputs.sort:
+        fact_inputs["sort"] = True
+    if inputs.dedup:
+        fact_inputs["dedup"] = True
+    if etl_conf["datemode"] == 6 and "visitdatefile" in etl_conf:
+        fact_inputs["visitdatefile"] = file_hash(etl_conf["visitdatefile"])
+    return concept_inputs, fact_inputs
+
+
+def report_duplicates(etl, inputs):
+    if inputs.dedup:
+        print(f"{etl.duplicate_facts} duplicate facts dropped")
+
+
+def write_facts_file(etl, factsfile, inputs):
+    if inputs.workers > 1:
+        if inputs.nsample or inputs.nsubjects:
+            print("Error: sampling cannot be combined with --workers")
+            sys.exit(1)
+        if inputs.pipeline or inputs.sort or inputs.partitions or inputs.dedup:
+            print(
+                "Error: --pipeline, --sort, --partitions and --dedup cannot "
+                "be combined with --workers"
+            )
+            sys.exit(1)
+        if inputs.engine != "rows":
+            print("Error: --workers uses the rows engine")
+            sys.exit(1)
+        if is_compressed(inputs.input):
+            print("Error: --workers needs an uncompressed input file")
+            sys.exit(1)
+        with etl.stage("write_facts"):
+            return etl.write_facts_parallel(
+                factsfile, inputs.input, inputs.workers
+            )
+    elif inputs.engine == "columnar" and not (
+        inputs.format != "csv"
+        or inputs.nsample
+        or inputs.nsubjects
+        or inputs.pipeline
+        or inputs.sort
+        or inputs.partitions
+        or inputs.dedup
+    ):
+        with etl.stage("write_facts"):
+            return etl.write_columnar_facts(factsfile, inputs.input)
+    else:
+        facts = generate_facts(etl, inputs)
+        if inputs.format != "csv":
+            with etl.stage("write_facts"):
+                return etl.write_facts_table(
+                    factsfile,
+                    inputs.format,
+                    inputs.nsample,
+                    facts,
+                    inputs.seed,
+                    inputs.nsubjects,
+                    inputs.pipeline,
+                    inputs.sort,
+                    inputs.dedup,
+                )
+        with etl.stage("write_facts"):
+            return etl.write_facts(
+                factsfile,
+                inputs.nsample,
+                facts,
+                inputs.seed,
+                inputs.nsubjects,
+                inputs.pipeline,
+                inputs.sort,
+                inputs.partitions,
+                inputs.dedup,
+            )
+
+
+#
+# Database backend for --db: facts and concepts are loaded in batches into
+# tables shaped like i2b2's observation_fact and concept_dimension, instead
+# of being written to CSV files. sourcesystem_cd is the filebase; a load
+# replaces the rows of an earlier load of the same filebase in one
+# transaction. PostgreSQL tables are loaded with COPY, SQLite tables with
+# executemany. Connections are kept open per process and URL, so batch
+# jobs in the same worker process share them.
+#
+DB_TABLES = {
+    "observation_fact": (
+        ("mrn", "TEXT"),
+        ("start_date", "DATE"),
+        ("concept_cd", "TEXT"),
+        ("tval_char", "TEXT"),
+        ("sourcesystem_cd", "TEXT"),
+    ),
+    "concept_dimension": (
+        ("concept_path", "TEXT"),
+        ("concept_cd", "TEXT"),
+        ("concept_type", "TEXT"),
+        ("sourcesystem_cd", "TEXT"),
+    ),
+}
+_db_connections = {}  # URL -> open connection
+
+
+class DatabaseLoader:
+    def __init__(self, url):
+        self.postgres = url.startswith(("postgresql://", "postgres://"))
+        if url not in _db_connections:
+            _db_connections[url] = self.connect(url)
+        self.connection = _db_connections[url]
+        cursor = self.connection.cursor()
+        for table, columns in DB_TABLES.items():
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                + ", ".join(f"{name} {type}" for name, type in columns)
+                + ")"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_source "
+                f"ON {table} (sourcesystem_cd)"
+            )
+        self.connection.commit()
+
+    def connect(self, url):
+        if self.postgres:
+            if psycopg2 is None:
+                print("Error: PostgreSQL databases require psycopg2")
+                sys.exit(1)
+            return psycopg2.connect(url)
+        elif url.startswith("sqlite:///"):
+            # Writers of other batch jobs may hold the lock for a while
+            return sqlite3.connect(url[len("sqlite:///") :], timeout=600)
+        else:
+            print(f"Error: unsupported database URL {url}")
+            sys.exit(1)
+
+    #
+    # Replace the rows of source in table by the rows of batches, a
+    # sequence of lists of rows without the sourcesystem_cd column.
+    # Returns the number of rows loaded.
+    #
+    def replace(self, table, batches, source):
+        columns = [name for name, _ in DB_TABLES[table]]
+        placeholder = "%s" if self.postgres else "?"
+        nrows = 0
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE sourcesystem_cd = {placeholder}",
+                (source,),
+            )
+            for batch in batches:
+                rows = [row + (source,) for row in batch]
+                if self.postgres:
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows(rows)
+                    buffer.seek(0)
+                    cursor.copy_expert(
+                        f"COPY {table} ({', '.join(columns)}) "
+                        "FROM STDIN WITH (FORMAT csv)",
+                        buffer,
+                    )
+                else:
+                    cursor.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+                        f"({', '.join(placeholder for _ in columns)})",
+                        rows,
+                    )
+                nrows += len(rows)
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return nrows
+
+
+#
+# Load the facts and concepts of an input into the database of inputs.db.
+# Returns the number of facts loaded.
+#
+def load_database(etl, inputs):
+    loader = DatabaseLoader(inputs.db)
+    source = etl.config["filebase"]
+    facts = generate_facts(etl, inputs)
+    with etl.stage("load_facts"):
+        facts = etl.select_facts(
+            inputs.nsample, facts, inputs.seed, inputs.nsubjects
+        )
+        nfacts = loader.replace(
+            "observation_fact",
+            etl.fact_batches(
+                facts, inputs.pipeline, inputs.sort, ".", inputs.dedup
+            ),
+            source,
+        )
+        report_duplicates(etl, inputs)
+    with etl.stage("load_concepts"):
+        concepts = etl.concept_rows()
+        if etl.icd_codes() and etl.read_icd_codes(ICD_CODES_FILE):
+            concepts += etl.icd_concept_rows()
+        loader.replace("concept_dimension", [concepts], source)
+    print(
+        f"{nfacts} facts and {len(concepts)} concepts loaded into {inputs.db}"
+    )
+    return nfacts
+
+
+# The facts of the input, generated by the engine selected by inputs
+def generate_facts(etl, inputs):
+    if inputs.engine == "columnar":
+        return etl.columnar_facts(inputs.input)
+    elif inputs.pipeline:
+        return etl.pipeline_facts(inputs.input)
+    elif inputs.stream:
+        return etl.stream_facts(inputs.input)
+    with etl.stage("read_facts"):
+        etl.read_facts(inputs.input)
+    with etl.stage("collect_facts"):
+        return etl.collect_facts(inputs.compact)
+
+
+#
+# ETL of one input file. Returns the number of facts written.
+#
+def run_etl(etl_conf, inputs, references=None, stats=None):
+    if inputs.profile:
+        inputs = argparse.Namespace(**dict(vars(inputs), profile=False))
+        return profiled(
+            etl_conf["filebase"] + "_profile.prof",
+            run_etl,
+            etl_conf,
+            inputs,
+            references,
+            stats,
+        )
+    if stats is None and inputs.stats:
+        stats = RunStats(etl_conf["filebase"])
+    etl = ETLdbGap(etl_conf, references, stats)
+    cached = False
+    with etl.stage("read_data_dictionary"):
+        if references is not None and references.keep_concepts:
+            etl.reference_concepts(inputs.dictionary)
+            cached = True
+        elif inputs.cache_dir:
+            cached = etl.load_concepts(inputs.dictionary, inputs.cache_dir)
+        if not cached:
+            etl.read_data_dictionary(inputs.dictionary)
+    with etl.stage("read_references"):
+        etl.read_visit_dates_file()
+        etl.read_demographics_file()
+    if not cached:
+        with etl.stage("map_concepts"):
+            etl.map_concepts()
+            if inputs.cache_dir:
+                etl.save_concepts(inputs.dictionary, inputs.cache_dir)
+    if inputs.db:
+        if (
+            inputs.workers > 1
+            or inputs.incremental
+            or inputs.delta_from
+            or inputs.partitions
+        ):
+            print(
+                "Error: --db cannot be combined with --workers, --incremental, "
+                "--delta-from or --partitions"
+            )
+            sys.exit(1)
+        nfacts = load_database(etl, inputs)
+        if inputs.stats:
+            stats.report()
+        return nfacts
+    cache = None
+    concept_inputs = fact_inputs = None
+    if inputs.incremental:
+        cache = BuildCache(etl_conf["filebase"] + "_build.json")
+        concept_inputs, fact_inputs = build_inputs(etl_conf, inputs)
+
+    if inputs.format != "csv" and (
+        inputs.workers > 1 or inputs.delta_from or inputs.compress
+    ):
+        print(
+            f"Error: --format {inputs.format} cannot be combined with "
+            "--workers, --delta-from or --compress"
+        )
+        sys.exit(1)
+    if inputs.partitions and (
+        inputs.format != "csv" or inputs.incremental or inputs.delta_from
+    ):
+        print(
+            "Error: --partitions writes CSV files and cannot be combined with "
+            "--format, --incremental or --delta-from"
+        )
+        sys.exit(1)
+    extension = OUTPUT_SUFFIXES[inputs.format]
+    conceptsfile = etl_conf["filebase"] + "_concepts" + extension
+    if cache and cache.current(conceptsfile, concept_inputs):
+        print(f"{conceptsfile} is up to date")
+    else:
+        with etl.stage("write_concepts"):
+            etl.write_concepts(conceptsfile, inputs.format)
+        if cache:
+            cache.record(conceptsfile, concept_inputs)
+
+    suffix = COMPRESSION_SUFFIXES.get(inputs.compress, "")
+    factsfile = etl_conf["filebase"] + "_facts" + extension + suffix
+    built = cache and cache.current(factsfile, fact_inputs)
+    if inputs.delta_from:
+        if (
+            inputs.workers > 1
+            or inputs.pipeline
+            or inputs.sort
+            or inputs.dedup
+            or inputs.nsample
+            or inputs.nsubjects
+        ):
+            print(
+                "Error: --delta-from cannot be combined with --workers, "
+                "--pipeline, --sort, --dedup or sampling"
+            )
+            sys.exit(1)
+        with etl.stage("write_facts_delta"):
+            nfacts, nretracted = etl.write_facts_delta(
+                inputs.input,
+                inputs.delta_from,
+                etl_conf["filebase"] + "_rows.jsonl",
+                etl_conf["filebase"] + "_facts_delta.csv" + suffix,
+                etl_conf["filebase"] + "_facts_retracted.csv" + suffix,
+            )
+        print(f"{nfacts} new facts, {nretracted} retracted facts")
+        built = None
+        fact_inputs = None  # Delta runs bypass the build cache
+    elif built:
+        print(f"{factsfile} is up to date")
+        nfacts = built["facts"]
+    else:
+        nfacts = write_facts_file(etl, factsfile, inputs)
+        report_duplicates(etl, inputs)
+        if cache:
+            cache.record(factsfile, fact_inputs, facts=nfacts)
+
+    if etl.icd_codes():
+        # The ICD concepts of delta facts go to a file of their own, so that
+        # those of the full facts file are kept
+        delta = "_delta" if inputs.delta_from else ""
+        conceptsfile = (
+            etl_conf["filebase"] + "_icd_concepts" + delta + extension
+        )
+        icd_inputs = None
+        if fact_inputs is not None:
+            icd_inputs = dict(fact_inputs, icd_codes=file_hash(ICD_CODES_FILE))
+        if cache and cache.current(conceptsfile, icd_inputs):
+            print(f"{conceptsfile} is up to date")
+        else:
+            with etl.stage("write_icd_concepts"):
+                if etl.read_icd_codes(ICD_CODES_FILE):
+                    if built:
+                        etl.read_used_icd_codes(factsfile)
+                    etl.write_icd_concepts(conceptsfile, inputs.format)
+                    if cache:
+                        cache.record(conceptsfile, icd_inputs)
+    if inputs.stats:
+        stats.report()
+    return nfacts
+
+
+#
+# Run function under cProfile, write the profile to path for pstats or
+# snakeviz, and print the functions with the most cumulative time
+#
+def profiled(path, function, *args):
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        profile.dump_stats(path)
+        print(f"Profile written to {path}")
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(20)
+
+
+#
+# Batch mode: ETL every job of a manifest, a YAML list of config, input and
+# dictionary files (optionally with a filebase overriding the config):
+#
+# jobs:
+#   - config: AREDS_followup.yml
+#     input: areds_followup.txt
+#     dictionary: dbGaP_Data_Dictionary_AREDS_followup_x.csv
+#
+# The ICD code map, visit date and demographics files are loaded once and
+# shared by all jobs, which run in a pool of inputs.jobs processes.
+#
+def run_batch(inputs):
+    manifest = load_conf(inputs.batch)
+    if isinstance(manifest, dict):
+        manifest = manifest["jobs"]
+    references = ReferenceTables()
+    jobs = []
+    for job in manifest:
+        etl_conf = load_conf(job["config"])
+        if "filebase" in job:
+            etl_conf["filebase"] = job["filebase"]
+        if etl_conf["datemode"] == 6 and "visitdatefile" in etl_conf:
+            references.load(load_visit_dates, etl_conf["visitdatefile"])
+        if "demographics_file" in etl_conf:
+            references.load(load_demographics, etl_conf["demographics_file"])
+        job_inputs = argparse.Namespace(**vars(inputs))
+        job_inputs.input = job["input"]
+        job_inputs.dictionary = job["dictionary"]
+        job_inputs.workers = 1  # Jobs are the unit of parallelism
+        jobs.append((etl_conf, job_inputs))
+    if os.path.exists(ICD_CODES_FILE):
+        references.load(load_icd_codes, ICD_CODES_FILE)
+
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        inputs.jobs, initializer=init_batch_worker, initargs=(references,)
+    ) as pool:
+        futures = [pool.submit(run_job, *job) for job in jobs]
+        for (etl_conf, job_inputs), future in zip(jobs, futures):
+            try:
+                nfacts, seconds = future.result()
+            except (Exception, SystemExit) as e:
+                failed += 1
+                print(f"{etl_conf['filebase']}: failed: {e!r}")
+            else:
+                print(
+                    f"{etl_conf['filebase']}: {nfacts} facts in "
+                    f"{seconds:.1f}s ({job_inputs.input})"
+                )
+    print(
+        f"{len(jobs) - failed} of {len(jobs)} jobs done in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    if failed:
+        sys.exit(1)
+
+
+#
+# Daemon mode: an HTTP server, on a Unix socket when the address is a path,
+# else on host:port, that runs ETL jobs on a pool of inputs.jobs processes.
+# The workers keep the reference tables and parsed data dictionaries of
+# earlier jobs and reload a file when it changes. A job is a POST of a JSON
+# object with the command-line arguments of the job and optionally a
+# filebase that overrides the one in its config:
+#
+# {"args": ["-c", "AREDS_followup.yml", "-i", "areds_followup.txt",
+#           "-d", "dbGaP_Data_Dictionary_AREDS_followup_x.csv", "--sort"]}
+#
+# The response has the number of facts, the stage timings and counters of
+# --stats and the output of the job, or its error. A GET returns the number
+# of jobs run and failed. When a worker dies, its job fails and the pool
+# is replaced, with cold caches. Jobs are not authenticated and read and write
+# any file the daemon can, so it only listens on loopback hosts.
+#
+def serve(inputs):
+    host, colon, port = inputs.serve.rpartition(":")
+    unix = not (colon and port.isdigit())
+    if unix:
+        if os.path.exists(inputs.serve):
+            if not stat.S_ISSOCK(os.stat(inputs.serve).st_mode):
+                print(f"Error: {inputs.serve} exists and is not a socket")
+                sys.exit(1)
+            os.remove(inputs.serve)  # Left by an earlier daemon
+        server = UnixHTTPServer(inputs.serve, JobHandler)
+    else:
+        if not is_loopback(host):
+            print(
+                f"Error: --serve only listens on loopback hosts, e.g. "
+                f"localhost:{port}"
+            )
+            sys.exit(1)
+        server = ThreadingHTTPServer((host, int(port)), JobHandler)
+    server.jobs = inputs.jobs
+    server.pool = job_pool(inputs.jobs)
+    server.counts = Counter()
+    server.lock = threading.Lock()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving ETL jobs on {inputs.serve}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if unix:
+            os.remove(inputs.serve)
+
+
+def job_pool(jobs):
+    return ProcessPoolExecutor(
+        jobs,
+        initializer=init_batch_worker,
+        initargs=(ReferenceTables(keep_concepts=True),),
+    )
+
+
+# True if every IPv4 address of host is a loopback address
+def is_loopback(host):
+    if not host:  # All interfaces
+        return False
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a host and port
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.reply(200, dict(self.server.counts))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            inputs = parse_args(request["args"])
+            if inputs.batch or inputs.serve:
+                raise ValueError("jobs cannot use --batch or --serve")
+            etl_conf = load_conf(inputs.config)
+        except (ValueError, KeyError, TypeError, OSError, SystemExit) as e:
+            self.reply(400, {"error": repr(e)})
+            return
+        if "filebase" in request:
+            etl_conf["filebase"] = request["filebase"]
+        inputs.workers = 1  # Jobs are the unit of parallelism
+        pool = self.server.pool
+        try:
+            result = pool.submit(serve_job, etl_conf, inputs).result()
+        except BrokenProcessPool as e:  # A worker died, e.g. killed
+            result = {"error": repr(e)}
+            with self.server.lock:
+                if self.server.pool is pool:  # Not replaced by another job
+                    self.server.pool = job_pool(self.server.jobs)
+                    pool.shutdown(wait=False)
+        except Exception as e:
+            result = {"error": repr(e)}
+        with self.server.lock:
+            self.server.counts["jobs"] += 1
+            if "error" in result:
+                self.server.counts["failed"] += 1
+        self.reply(500 if "error" in result else 200, result)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+
+def main():
+    inputs = parse_args()
+    if inputs.serve:
+        serve(inputs)
+    elif inputs.batch:
+        run_batch(inputs)
+    else:
+        etl_conf = load_conf(inputs.config)
+        run_etl(etl_conf, inputs)
 
 
 if __name__ == "__main__":